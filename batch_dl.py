@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+
+# Batch downloader: runs every title of a jobs file, across sites, through
+# one thread pool. Each site gets a budget of tasks (chapter downloads, list
+# fetches) that may run at once, so while one host is slow or throttling us,
+# the other sites' tasks keep the pool busy.
+#
+# Jobs file, one title per line ('#' starts a comment):
+#   <site> <title> [option=value ...]
+#
+#   novelfull    my-senior-brother-is-too-steady   format=epub
+#   webnovelpub  the-regressed-demon-lord-is-kind-04022146  volume_size=200
+#   wuxia        the-second-coming-of-gluttony
+#   mtowndl      swot   dir=Swot_Manga cstart=1 cstop=20 format=cbz
+#   mangadex     12345  dir=Some_Manga lang=English cstart=1 cstop=10
+#
+# Usage: python batch_dl.py jobs.txt [--budget mtowndl=2] [--titles 4]
+import argparse
+import importlib
+import os
+import sys
+import threading
+import traceback
+from collections import defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "manga_scrapers"))
+import htmlparse
+import httpcache
+import metrics
+import novelrender
+import novelstore
+
+#--------   constants   --------
+# tasks that may run at once per site
+SITE_BUDGETS = {"novelfull": 2, "webnovelpub": 2, "wuxia": 2, "mtowndl": 1, "mangadex": 2}
+TITLES = 4                                      # titles in progress at once
+#--------   /constants  --------
+
+
+@dataclass
+class Job:
+    site: str
+    title: str
+    options: dict = field(default_factory=dict)
+    line: int = 0
+
+    def option(self, key, default=None, kind=str):
+        value = self.options.get(key)
+        return default if value is None else kind(value)
+
+
+def is_true(value):
+    return value.lower() in ("1", "yes", "true")
+
+
+def read_jobs(path):
+    jobs = []
+    with open(path) as f:
+        for num, line in enumerate(f, 1):
+            words = line.split("#")[0].split()
+            if not words:
+                continue
+            if len(words) < 2 or not all("=" in word for word in words[2:]):
+                raise ValueError(f"{path}:{num}: expected '<site> <title> [option=value ...]'")
+            options = dict(word.split("=", 1) for word in words[2:])
+            jobs.append(Job(words[0], words[1], options, num))
+    return jobs
+
+
+class SiteScheduler:
+    """
+    One thread pool shared by all sites. A site never has more than its budget
+    of tasks running; the rest wait in the site's own queue, without holding a
+    thread, so the pool's threads go to the sites that can make progress.
+    """
+
+    def __init__(self, budgets, workers=None):
+        self.budgets = budgets
+        self.executor = ThreadPoolExecutor(max_workers=workers or sum(budgets.values()))
+        self.running = defaultdict(int)
+        self.pending = defaultdict(deque)
+        self.lock = threading.Lock()
+
+    def submit(self, site, fn, *args):
+        future = Future()
+        with self.lock:
+            self.pending[site].append((future, fn, args))
+        self._dispatch(site)
+        return future
+
+    def _dispatch(self, site):
+        ready = []
+        with self.lock:
+            while self.pending[site] and self.running[site] < self.budgets.get(site, 1):
+                ready.append(self.pending[site].popleft())
+                self.running[site] += 1
+        for task in ready:
+            self.executor.submit(self._run, site, *task)
+
+    def _run(self, site, future, fn, args):
+        if future.set_running_or_notify_cancel():
+            try:
+                future.set_result(fn(*args))
+            except BaseException as exc:
+                future.set_exception(exc)
+        with self.lock:
+            self.running[site] -= 1
+        self._dispatch(site)
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+#-------------------------------#
+#  Site adapters                #
+#-------------------------------#
+class NovelAdapter:
+    """
+    Novel sites: chapter list -> missing chapters into the NovelStore -> PDF or EPUB.
+    Subclasses wire in the functions of the site's script.
+    """
+    module_name = None
+
+    def __init__(self):
+        self.module = importlib.import_module(self.module_name)
+
+    def chapter_list(self, job):
+        return self.module.get_chapter_list(job.title, 1)
+
+    def list_url(self, job, page_num):
+        return self.module.URL_MAIN.format(slug=job.title, page_num=page_num)
+
+    def list_request(self, job):
+        """
+        URL of the page that changes when a chapter is added, and the getter to fetch it with.
+        The lists are oldest first, so that is the last page; page 1 is fetched to find it.
+        """
+        getter = self.module.rate_limiter.limit(metrics.instrument(self.module.session.get, "list_fetch"))
+        url = self.list_url(job, 1)
+        resp = httpcache.http_cache.get(url, 0, getter)
+        if not resp.ok:
+            raise RuntimeError(f"status {resp.status_code} for {url}")
+        return self.list_url(job, self.module.count_pages(htmlparse.parse(resp.text))), getter
+
+    def key(self, chapter):
+        return chapter.url
+
+    def fetch(self, chapter_list, chapter):
+        return self.module.fetch_chapter(chapter)
+
+    def render(self, job, chapter_list, store):
+        if job.option("format", "pdf") == "epub":
+            self.module.make_epub(chapter_list, store, job.title)
+        else:
+            self.module.make_pdf(chapter_list, store, job.title, job.option("volume_size", 0, int),
+                                 job.option("split", False, is_true), novelrender.RENDER_JOBS)
+
+    def run(self, job, scheduler):
+        chapter_list = scheduler.submit(job.site, self.chapter_list, job).result()
+        store = novelstore.NovelStore(job.title)
+        missing = store.missing(chapter_list)
+        print(f"[{job.site} {job.title}] {len(missing)} new chapters of {len(chapter_list)}")
+
+        futures = [(chapter, scheduler.submit(job.site, self.fetch, chapter_list, chapter)) for chapter in missing]
+        for chapter, future in futures:
+            store.add(chapter, future.result())
+        store.save()
+        self.render(job, chapter_list, store)
+
+    def download_new(self, job, chapters, scheduler):
+        # the book is rebuilt; chapters downloaded before come from the store
+        self.run(job, scheduler)
+
+
+class NovelfullAdapter(NovelAdapter):
+    module_name = "novelfull_dl"
+
+    def list_url(self, job, page_num):
+        return self.module.URL.format(novelName=job.title, pageNum=page_num)
+
+    def fetch(self, chapter_list, chapter):
+        return self.module.get_chapter_processed(chapter_list, chapter.index)
+
+
+class WebnovelpubAdapter(NovelAdapter):
+    module_name = "webnovelpub_dl"
+
+
+class WuxiaAdapter(NovelAdapter):
+    module_name = "wuxia_dl"
+
+    def __init__(self):
+        super().__init__()
+        import cloudscraper
+        import httpsession
+        self.scraper = httpsession.configure(cloudscraper.create_scraper())
+
+    def chapter_list(self, job):
+        return self.module.get_chapter_list(job.title, self.scraper)
+
+    def list_request(self, job):
+        return self.module.URL.format(novelName=job.title), self.module.rate_limiter.limit(
+            metrics.instrument(self.scraper.get, "list_fetch"))
+
+    def fetch(self, chapter_list, chapter):
+        return self.module.fetch_chapter(chapter, self.scraper)
+
+
+class MangaAdapter:
+    """
+    Manga sites: one task per chapter, saved under the job's dir= (default: the title)
+    """
+    module_name = None
+
+    def __init__(self):
+        self.module = importlib.import_module(self.module_name)
+
+    def chapter_range(self, job, chapters):
+        start = job.option("cstart", 1, int)
+        stop = job.option("cstop", len(chapters), int)
+        return chapters[start-1:stop]
+
+    def run(self, job, scheduler):
+        chapters = scheduler.submit(job.site, self.chapter_list, job).result()
+        self.download_new(job, chapters, scheduler)
+
+    def download_new(self, job, chapters, scheduler):
+        root = job.option("dir", job.title)
+        os.makedirs(root, exist_ok=True)
+        print(f"[{job.site} {job.title}] downloading {len(chapters)} chapters to {root}")
+        futures = [scheduler.submit(job.site, self.download, job, chapter, root) for chapter in chapters]
+        for future in futures:
+            future.result()
+
+
+class MtowndlAdapter(MangaAdapter):
+    module_name = "mtowndl"
+
+    def __init__(self):
+        super().__init__()
+        self.module.SUPPRESS_STDOUT = True          # no progress bars from several chapters at once
+
+    def chapter_list(self, job):
+        chapters = self.module.get_chapter_list(argparse.Namespace(name=job.title))
+        if chapters is None:
+            raise RuntimeError("could not download the chapter list")
+        return self.chapter_range(job, chapters)
+
+    def list_request(self, job):
+        return self.module.URL.format(mangaName=job.title), self.module.list_get
+
+    def key(self, chapter):
+        return chapter.url
+
+    def download(self, job, chapter, root):
+        self.module.download_chapter(chapter, fmt=job.option("format", "dir"), series=job.title, root=root)
+
+
+class MangadexAdapter(MangaAdapter):
+    module_name = "mangadex_cli"
+
+    def chapter_list(self, job):
+        import mangadex_index
+        resp = httpcache.http_cache.get(self.module.BASE_URL_MANGA.format(job.title), httpcache.TTL_LIST,
+                                        metrics.instrument(self.module.session.get, "list_fetch"))
+        index = mangadex_index.MangaIndex()
+        try:
+            if resp.status_code == 200:
+                index.refresh(int(job.title), resp.text)
+            elif not index.has(int(job.title)):
+                raise RuntimeError(f"could not download the manga metadata (status {resp.status_code})")
+            job.options.setdefault("series", index.title(int(job.title)))
+            langs = job.option("lang", ",".join(self.module.ALLOWED_LANGS)).split(",")
+            stop = job.option("cstop", None, int)
+            return [chapter for lang in langs
+                    for chapter in index.chapters(int(job.title), lang, job.option("cstart", 1, int), stop)]
+        finally:
+            index.close()
+
+    def list_request(self, job):
+        return self.module.BASE_URL_MANGA.format(job.title), metrics.instrument(self.module.session.get, "list_fetch")
+
+    def key(self, chapter):
+        return chapter[1]
+
+    def download(self, job, chapter, root):
+        lang, chapter_id = chapter
+        self.module.download_chapter(lang, chapter_id, root, job.option("format", "dir"), job.option("series", ""))
+
+
+ADAPTERS = {
+    "novelfull": NovelfullAdapter,
+    "webnovelpub": WebnovelpubAdapter,
+    "wuxia": WuxiaAdapter,
+    "mtowndl": MtowndlAdapter,
+    "mangadex": MangadexAdapter,
+}
+
+
+def run_jobs(jobs, budgets, titles=TITLES, workers=None):
+    """
+    Run every job; returns the jobs that failed
+    """
+    scheduler = SiteScheduler(budgets, workers)
+    adapters = {}
+    lock = threading.Lock()
+    failed = []
+
+    def adapter(site):
+        with lock:
+            if site not in adapters:
+                adapters[site] = ADAPTERS[site]()
+            return adapters[site]
+
+    def run(job):
+        try:
+            adapter(job.site).run(job, scheduler)
+            print(f"[{job.site} {job.title}] done")
+        except Exception:
+            print(f"[{job.site} {job.title}] failed:")
+            traceback.print_exc()
+            failed.append(job)
+
+    # the titles only wait on their tasks; the work itself runs on the scheduler's pool
+    with ThreadPoolExecutor(max_workers=titles) as executor:
+        list(executor.map(run, jobs))
+    scheduler.shutdown()
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("jobs", help="Jobs file: '<site> <title> [option=value ...]' per line")
+    parser.add_argument("--budget", action="append", default=[], metavar="SITE=N",
+                        help="Tasks that may run at once for a site")
+    parser.add_argument("--titles", type=int, default=TITLES, help="Titles in progress at once")
+    parser.add_argument("--workers", type=int, help="Threads in the shared pool (default: sum of the budgets)")
+    parser.add_argument("--no-cache", action="store_true", help="Bypass the shared HTTP cache")
+    parser.add_argument("--metrics", help="Export Prometheus metrics to this file (and a JSON run summary next to it)")
+    args = parser.parse_args()
+
+    httpcache.http_cache.enabled = not args.no_cache
+    metrics.configure(args.metrics)
+    budgets = dict(SITE_BUDGETS)
+    for budget in args.budget:
+        site, _, num = budget.partition("=")
+        budgets[site] = int(num)
+
+    jobs = read_jobs(args.jobs)
+    unknown = {job.site for job in jobs} - set(ADAPTERS)
+    if unknown:
+        parser.error(f"unknown site(s): {', '.join(sorted(unknown))}; known: {', '.join(ADAPTERS)}")
+
+    failed = run_jobs(jobs, budgets, args.titles, args.workers)
+    print(f"{len(jobs) - len(failed)} of {len(jobs)} titles done")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
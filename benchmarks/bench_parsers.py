@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+# Micro-benchmark for htmlparse: pages/sec per bs4 backend, parsing whole
+# pages vs. only the chapter container.
+#
+# Usage: python benchmarks/bench_parsers.py [page.html ...]
+# Without files, a synthetic novelfull-like chapter page is used.
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import htmlparse
+
+#--------   constants   --------
+BACKENDS = ["lxml", "html.parser", "html5lib"]
+TARGET = ("div", {"id": "chapter-content"})
+MIN_SECONDS = 2                                 # run each case for at least this long
+#--------   /constants  --------
+
+
+def synthetic_page():
+    nav = "".join(f'<li><a href="/genre/{i}">Genre {i}</a></li>' for i in range(80))
+    paragraphs = "".join(f"<p>Paragraph {i} of the chapter, with <i>some</i> text in it.</p>" for i in range(120))
+    sidebar = "".join(f'<div class="item"><a href="/novel/{i}">Novel {i}</a><span>{i} chapters</span></div>'
+                      for i in range(150))
+    return f"""<!DOCTYPE html><html><head><title>Chapter 1</title>
+        <script>var x = 1;</script></head><body>
+        <ul class="nav">{nav}</ul>
+        <div id="chapter"><h3>Chapter 1</h3>
+        <div id="chapter-content"><script>ads()</script>{paragraphs}
+        <div class="ads">ad</div><a href="/next">Next</a></div></div>
+        <div class="sidebar">{sidebar}</div>
+        </body></html>"""
+
+
+def bench(pages, backend, name, attrs):
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < MIN_SECONDS:
+        for page in pages:
+            htmlparse.parse(page, name, attrs, backend=backend, fallback=None)
+            count += 1
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs="*", help="HTML pages to parse")
+    args = parser.parse_args()
+
+    pages = []
+    for fname in args.files:
+        with open(fname, encoding="utf-8", errors="replace") as f:
+            pages.append(f.read())
+    pages = pages or [synthetic_page()]
+
+    print(f"{'backend':<12} {'full pages/s':>14} {'scoped pages/s':>16}")
+    for backend in BACKENDS:
+        if not htmlparse.backend_available(backend):
+            print(f"{backend:<12} {'not installed':>14}")
+            continue
+        full = bench(pages, backend, None, None)
+        scoped = bench(pages, backend, *TARGET)
+        print(f"{backend:<12} {full:>14.1f} {scoped:>16.1f}")
+
+
+if __name__ == '__main__':
+    main()
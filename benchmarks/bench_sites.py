@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+# Offline throughput benchmark for the scrapers.
+#
+# Starts the stand-in server (standin_server.py), then runs each scraper's
+# main() in a child process with its site URLs pointed at the server, and
+# reports chapters/sec, requests/sec, bytes/sec and the child's peak RSS.
+#
+# Usage:
+#   python benchmarks/bench_sites.py                        all sites
+#   python benchmarks/bench_sites.py novelfull mtowndl --latency 0.05 --error-rate 0.02
+#   python benchmarks/bench_sites.py --save baseline.json
+#   python benchmarks/bench_sites.py --compare baseline.json   exits 1 on a regression
+import argparse
+import importlib
+import importlib.util
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.join(BENCH_DIR, os.pardir)
+sys.path[:0] = [BENCH_DIR, ROOT_DIR, os.path.join(ROOT_DIR, "manga_scrapers")]
+import standin_server
+
+#--------   constants   --------
+RATE = "1000"                                   # effectively no client-side throttling
+REGRESSION_THRESHOLD = 0.10                     # 10% slower / bigger counts as a regression
+
+# module to run, and its command line; {chapters} and {workers} are filled in
+SCENARIOS = {
+    "novelfull":   ("novelfull_dl", ["bench-novel", "--no-cache", "--rate", RATE, "--fixed-rate",
+                                     "--workers", "{workers}", "--format", "{format}"]),
+    "webnovelpub": ("webnovelpub_dl", ["bench-novel", "--no-cache", "--rate", RATE, "--fixed-rate",
+                                       "--workers", "{workers}", "--format", "{format}"]),
+    "wuxia":       ("wuxia_dl", ["bench-novel", "--no-cache", "--rate", RATE, "--fixed-rate",
+                                 "--workers", "{workers}", "--format", "{format}"]),
+    "mtowndl":     ("mtowndl", ["bench-manga", "out", "--no-cache", "--rate", RATE, "--fixed-rate",
+                                "--page-workers", "{workers}", "--image-workers", "{workers}"]),
+    "mangadex":    ("mangadex_cli", ["42", "out", "--cstart", "1", "--cstop", "{chapters}", "--no-cache",
+                                     "--index", "index.sqlite"]),
+}
+REQUIRES = {"wuxia": "cloudscraper"}
+#--------   /constants  --------
+
+
+def run_child(site, base, argv):
+    """
+    Runs in the child process: point the module's site URLs at the
+    stand-in server and call its main()
+    """
+    def local(value):
+        if isinstance(value, str) and value.startswith("https://"):
+            return re.sub(r"^https://", base + "/", value)
+        if isinstance(value, (list, tuple)):              # e.g. mangadex_cli.FALLBACK_SERVERS
+            return type(value)(local(item) for item in value)
+        return value
+
+    module = importlib.import_module(SCENARIOS[site][0])
+    for name, value in list(vars(module).items()):
+        if isinstance(value, (str, list, tuple)):
+            setattr(module, name, local(value))
+
+    sys.argv = [module.__file__] + argv
+    module.main()
+
+
+def run_site(server, site, args):
+    module, argv = SCENARIOS[site]
+    argv = [arg.format(chapters=args.chapters, workers=args.workers, format=args.format) for arg in argv]
+
+    workdir = tempfile.mkdtemp(prefix=f"bench_{site}_")
+    output = None if args.verbose else subprocess.DEVNULL
+    server.stats.reset()
+    try:
+        start = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--child", site,
+                                 "--base", server.base, "--", *argv],
+                                cwd=workdir, stdout=output, stderr=output)
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        elapsed = time.perf_counter() - start
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    served = server.stats.snapshot()
+    return {
+        "exit_code": proc.returncode,
+        "seconds": elapsed,
+        "chapters_per_sec": args.chapters / elapsed,
+        "requests_per_sec": served["requests"] / elapsed,
+        "bytes_per_sec": served["bytes"] / elapsed,
+        "requests": served["requests"],
+        "injected_errors": served["errors"],
+        "peak_rss_mb": usage.ru_maxrss / 1024,    # ru_maxrss is in KiB on Linux
+    }
+
+
+def print_results(results):
+    print(f"{'site':<12} {'exit':>4} {'secs':>7} {'chap/s':>8} {'req/s':>8} {'MB/s':>7} {'errors':>6} {'rss MB':>7}")
+    for site, res in results.items():
+        print(f"{site:<12} {res['exit_code']:>4} {res['seconds']:>7.2f} {res['chapters_per_sec']:>8.2f} "
+              f"{res['requests_per_sec']:>8.1f} {res['bytes_per_sec'] / 1024**2:>7.2f} "
+              f"{res['injected_errors']:>6} {res['peak_rss_mb']:>7.1f}")
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """
+    Returns a description of every metric that got worse than the baseline by more than threshold
+    """
+    regressions = []
+    for site, res in results.items():
+        old = baseline.get(site)
+        if not old:
+            continue
+        if res["chapters_per_sec"] < old["chapters_per_sec"] * (1 - threshold):
+            regressions.append(f"{site}: {old['chapters_per_sec']:.2f} -> {res['chapters_per_sec']:.2f} chapters/sec")
+        if res["peak_rss_mb"] > old["peak_rss_mb"] * (1 + threshold):
+            regressions.append(f"{site}: {old['peak_rss_mb']:.1f} -> {res['peak_rss_mb']:.1f} MB peak RSS")
+        if res["exit_code"] != 0:
+            regressions.append(f"{site}: exited with {res['exit_code']}")
+    return regressions
+
+
+def main():
+    if "--child" in sys.argv:
+        sep = sys.argv.index("--")
+        opts = dict(zip(sys.argv[1:sep:2], sys.argv[2:sep:2]))
+        run_child(opts["--child"], opts["--base"], sys.argv[sep+1:])
+        return
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("sites", nargs="*", default=list(SCENARIOS), help=f"Any of: {', '.join(SCENARIOS)}")
+    parser.add_argument("--chapters", type=int, default=40, help="Chapters per stand-in title")
+    parser.add_argument("--workers", type=int, default=4, help="Concurrency passed to the scrapers")
+    parser.add_argument("--format", default="epub", help="Novel output format (pdf needs wkhtmltopdf)")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random extra latency, up to this many seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with 503")
+    parser.add_argument("--fixtures", help="Directory of recorded responses to replay")
+    parser.add_argument("--save", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Baseline JSON file to check for regressions")
+    parser.add_argument("--verbose", action="store_true", help="Show the scrapers' output")
+    args = parser.parse_args()
+
+    cfg = standin_server.Config(args.chapters, args.latency, args.jitter, args.error_rate, args.fixtures)
+    server = standin_server.start(cfg)
+
+    results = {}
+    for site in args.sites:
+        required = REQUIRES.get(site)
+        if required and importlib.util.find_spec(required) is None:
+            print(f"Skipping {site}: {required} is not installed")
+            continue
+        results[site] = run_site(server, site, args)
+    server.shutdown()
+
+    print_results(results)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f))
+        for line in regressions:
+            print("REGRESSION:", line)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
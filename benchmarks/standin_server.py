@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+
+# Local stand-in for the sites the scrapers talk to.
+#
+# Requests are routed by their first path component, which is the real host
+# name: http://127.0.0.1:PORT/novelfull.com/some-novel.html?page=2 answers for
+# https://novelfull.com/some-novel.html?page=2. A response is taken from the
+# fixture directory when a recorded file exists for the URL, and generated
+# from the synthetic site models below otherwise.
+#
+# Recorded fixtures live at <fixtures>/<host>/<path>, with "?query" appended
+# to the file name as "@query" when there is one.
+import hashlib
+import http.server
+import json
+import mimetypes
+import os
+import random
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+#--------   constants   --------
+LIST_PAGE_SIZE = 50                             # chapters per list page (novelfull, webnovelpub)
+PARAGRAPHS = 80                                 # paragraphs per novel chapter
+PAGES_PER_CHAPTER = 20                          # manga pages per chapter
+IMAGE_BYTES = 150 * 1024
+#--------   /constants  --------
+
+
+class Config:
+    """
+    What the stand-in sites look like, and how badly they behave
+    """
+
+    def __init__(self, chapters=100, latency=0.0, jitter=0.0, error_rate=0.0, fixtures=None, seed=0):
+        self.chapters = chapters
+        self.latency = latency                  # seconds added to every response
+        self.jitter = jitter                    # up to this much more, at random
+        self.error_rate = error_rate            # share of requests answered with 503
+        self.fixtures = fixtures
+        self.random = random.Random(seed)
+        self.image = bytes(self.random.getrandbits(8) for _ in range(IMAGE_BYTES))
+
+
+#-------------------------------#
+#  Synthetic sites              #
+#-------------------------------#
+def _paragraphs(num):
+    return "".join(f"<p>Paragraph {i} of chapter {num}. " + "Lorem ipsum dolor sit amet. " * 6 + "</p>"
+                   for i in range(PARAGRAPHS))
+
+
+def _page(body):
+    return f"<!DOCTYPE html><html><head><title>stand-in</title></head><body>{body}</body></html>"
+
+
+def novelfull(path, query, cfg, base):
+    m = re.fullmatch(r"/([\w-]+)\.html", path)
+    if m:
+        name = m.group(1)
+        page = int(query.get("page", 1))
+        last = (cfg.chapters - 1) // LIST_PAGE_SIZE + 1
+        first = (page - 1) * LIST_PAGE_SIZE
+        links = [f'<li><a title="Chapter {i+1}" href="/{name}/chapter-{i+1}.html">Chapter {i+1}</a></li>'
+                 for i in range(first, min(first + LIST_PAGE_SIZE, cfg.chapters))]
+        half = len(links) // 2
+        return "text/html", _page(f"""<div id="list-chapter">
+            <ul class="list-chapter">{"".join(links[:half])}</ul>
+            <ul class="list-chapter">{"".join(links[half:])}</ul>
+            <ul class="pagination"><li class="last"><a data-page="{last-1}" href="#">Last</a></li></ul>
+            </div>""")
+
+    m = re.fullmatch(r"/[\w-]+/chapter-(\d+)\.html", path)
+    if m:
+        num = m.group(1)
+        return "text/html", _page(f"""<div id="chapter"><div id="chapter-content">
+            <script>ads();</script><h3>Chapter {num}</h3>{_paragraphs(num)}
+            <div class="ads">advert</div><a href="#">next</a></div></div>""")
+
+
+def webnovelpub(path, query, cfg, base):
+    m = re.fullmatch(r"/novel/([\w-]+)/chapters/page-(\d+)", path)
+    if m:
+        slug, page = m.group(1), int(m.group(2))
+        last = (cfg.chapters - 1) // LIST_PAGE_SIZE + 1
+        first = (page - 1) * LIST_PAGE_SIZE
+        items = "".join(f'<li data-chapterno="{i+1}"><a title="Chapter {i+1}" href="/novel/{slug}/chapter-{i+1}">'
+                        f'Chapter {i+1}</a></li>' for i in range(first, min(first + LIST_PAGE_SIZE, cfg.chapters)))
+        return "text/html", _page(f"""<ul class="chapter-list">{items}</ul>
+            <ul class="pagination"><li class="PagedList-skipToLast">
+            <a href="/novel/{slug}/chapters/page-{last}">&gt;&gt;</a></li></ul>""")
+
+    m = re.fullmatch(r"/novel/[\w-]+/chapter-(\d+)", path)
+    if m:
+        return "text/html", _page(f'<div id="chapter-container">{_paragraphs(m.group(1))}</div>')
+
+
+def wuxiaworld(path, query, cfg, base):
+    m = re.fullmatch(r"/novel/([\w-]+)", path)
+    if m:
+        name = m.group(1)
+        items = "".join(f'<li class="chapter-item"><a href="/novel/{name}/chapter-{i+1}">\nChapter {i+1}\n</a></li>'
+                        for i in range(cfg.chapters))
+        return "text/html", _page(f"<ul>{items}</ul>")
+
+    m = re.fullmatch(r"/novel/[\w-]+/chapter-(\d+)", path)
+    if m:
+        return "text/html", _page(f"""<div id="chapter-content"><script>ads();</script>
+            {_paragraphs(m.group(1))}<a href="#">next</a></div>""")
+
+
+def mangatown(path, query, cfg, base):
+    m = re.fullmatch(r"/manga/([\w-]+)", path)
+    if m:
+        name = m.group(1)
+        # newest first, like the real site
+        items = "".join(f'<li><a href="manga/{name}/c{i:03d}/">{name} {i}</a></li>'
+                        for i in range(cfg.chapters, 0, -1))
+        return "text/html", _page(f'<ul class="chapter_list">{items}</ul>')
+
+    m = re.fullmatch(r"/manga/([\w-]+)/c(\d+)/(?:(\d+)\.html)?", path)
+    if m:
+        name, chap, page = m.group(1), int(m.group(2)), int(m.group(3) or 1)
+        options = "".join(f'<option value="/manga/{name}/c{chap:03d}/{p}.html">{p}</option>'
+                          for p in range(1, PAGES_PER_CHAPTER + 1))
+        options += f'<option value="/manga/{name}/c{chap:03d}/featured.html">Featured</option>'
+        src = f"{base}/zjcdn.mangahere.org/store/manga/{name}/c{chap:03d}/q{page:03d}.jpg"
+        return "text/html", _page(f"""<div class="page_select"><select>{options}</select></div>
+            <img id="image" src="{src}"/>""")
+
+
+def mangahere_cdn(path, query, cfg, base):
+    if path.endswith(".jpg"):
+        return "image/jpeg", cfg.image
+
+
+def mangadex(path, query, cfg, base):
+    m = re.fullmatch(r"/api/manga/(\d+)", path)
+    if m:
+        chapters = {str(1000 + i): {"lang_name": "English", "volume": str(i // 10 + 1), "chapter": str(i + 1)}
+                    for i in range(cfg.chapters)}
+        return "application/json", json.dumps({"manga": {"title": "Stand-in"}, "chapter": chapters})
+
+    m = re.fullmatch(r"/api/chapter/(\d+)", path)
+    if m:
+        num = int(m.group(1)) - 1000
+        return "application/json", json.dumps({
+            "volume": str(num // 10 + 1), "chapter": str(num + 1), "title": f"Chapter {num+1}",
+            "hash": f"hash{num}", "server": f"{base}/s1.mangadex.org/data/",
+            "page_array": [f"p{p}.jpg" for p in range(1, PAGES_PER_CHAPTER + 1)],
+        })
+
+
+def mangadex_images(path, query, cfg, base):
+    if path.endswith(".jpg"):
+        return "image/jpeg", cfg.image
+
+
+SITES = {
+    "novelfull.com": novelfull,
+    "www.webnovelpub.com": webnovelpub,
+    "www.wuxiaworld.com": wuxiaworld,
+    "www.mangatown.com": mangatown,
+    "zjcdn.mangahere.org": mangahere_cdn,
+    "mangadex.org": mangadex,
+    "s1.mangadex.org": mangadex_images,
+}
+
+
+#-------------------------------#
+#  Server                       #
+#-------------------------------#
+class Stats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.errors = 0
+            self.bytes = 0
+
+    def add(self, size, error=False):
+        with self.lock:
+            self.requests += 1
+            self.bytes += size
+            self.errors += error
+
+    def snapshot(self):
+        with self.lock:
+            return {"requests": self.requests, "errors": self.errors, "bytes": self.bytes}
+
+
+def _recorded(cfg, host, path, query):
+    if not cfg.fixtures:
+        return None
+    fname = os.path.join(cfg.fixtures, host, path.lstrip("/") or "index")
+    if query:
+        fname += "@" + query
+    if not os.path.isfile(fname):
+        return None
+    with open(fname, "rb") as f:
+        return mimetypes.guess_type(path)[0] or "text/html", f.read()
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"               # keep-alive, like the real sites
+
+    def do_GET(self):
+        cfg, stats = self.server.cfg, self.server.stats
+        delay = cfg.latency + cfg.random.random() * cfg.jitter
+        if delay:
+            time.sleep(delay)
+
+        if cfg.random.random() < cfg.error_rate:
+            self.send_response(503)
+            self.send_header("Retry-After", "0")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            stats.add(0, error=True)
+            return
+
+        parts = urlsplit(self.path)
+        host, _, path = parts.path.lstrip("/").partition("/")
+        path = "/" + path
+        query = dict(pair.split("=", 1) for pair in parts.query.split("&") if "=" in pair)
+
+        found = _recorded(cfg, host, path, parts.query)
+        if found is None and host in SITES:
+            found = SITES[host](path, query, cfg, self.server.base)
+
+        if found is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            stats.add(0)
+            return
+
+        ctype, body = found
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+
+        # validators, so that conditional requests can be answered with a 304
+        etag = '"' + hashlib.sha1(body).hexdigest()[:16] + '"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            stats.add(0)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+        stats.add(len(body))
+
+    def log_message(self, *args):
+        pass
+
+
+def start(cfg, port=0):
+    """
+    Serve in a background thread; returns the server (base URL in .base)
+    """
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    server.cfg = cfg
+    server.stats = Stats()
+    server.base = f"http://127.0.0.1:{server.server_port}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+# Minimal EPUB 3 writer for the novel downloaders.
+# Chapters are written into the zip container one at a time as they are
+# added; the package document, nav and NCX are written when the book is
+# closed, from the titles collected along the way.
+import datetime
+import html
+import uuid
+import zipfile
+
+import bs4
+
+import metrics
+
+#--------   constants   --------
+CONTAINER_XML = """<?xml version="1.0" encoding="utf-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>
+"""
+
+CHAPTER_XHTML = """<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" lang="{lang}" xml:lang="{lang}">
+<head>
+  <meta charset="utf-8"/>
+  <title>{title}</title>
+</head>
+<body>
+{body}
+</body>
+</html>
+"""
+
+NAV_XHTML = """<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="{lang}" xml:lang="{lang}">
+<head>
+  <meta charset="utf-8"/>
+  <title>{title}</title>
+</head>
+<body>
+  <nav epub:type="toc" id="toc">
+    <h1>{title}</h1>
+    <ol>
+{items}
+    </ol>
+  </nav>
+</body>
+</html>
+"""
+
+TOC_NCX = """<?xml version="1.0" encoding="utf-8"?>
+<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">
+  <head>
+    <meta name="dtb:uid" content="{identifier}"/>
+  </head>
+  <docTitle><text>{title}</text></docTitle>
+  <navMap>
+{points}
+  </navMap>
+</ncx>
+"""
+
+CONTENT_OPF = """<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="book-id">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:identifier id="book-id">{identifier}</dc:identifier>
+    <dc:title>{title}</dc:title>
+    <dc:language>{lang}</dc:language>
+    <dc:source>{source}</dc:source>
+    <meta property="dcterms:modified">{modified}</meta>
+  </metadata>
+  <manifest>
+    <item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>
+    <item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>
+{items}
+  </manifest>
+  <spine toc="ncx">
+{itemrefs}
+  </spine>
+</package>
+"""
+#--------   /constants  --------
+
+
+def to_xhtml(fragment):
+    """
+    Re-serialize an HTML fragment as well-formed XHTML (closed void tags,
+    escaped text), which EPUB readers require. Scripts and styles are
+    dropped: their raw text would not be escaped.
+    """
+    soup = bs4.BeautifulSoup(fragment, "html.parser")
+    for tag in soup.find_all(["script", "style", "noscript"]):
+        tag.decompose()
+    return soup.decode(formatter="minimal")
+
+
+class EpubWriter:
+
+    def __init__(self, path, title, source="", lang="en"):
+        self.title = title
+        self.source = source
+        self.lang = lang
+        self.identifier = "urn:uuid:" + str(uuid.uuid5(uuid.NAMESPACE_URL, source or title))
+        self.chapters = []                      # (file name, title), in spine order
+
+        self.zip = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED)
+        # the mimetype must come first and be stored uncompressed
+        self.zip.writestr("mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        self.zip.writestr("META-INF/container.xml", CONTAINER_XML)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add_chapter(self, title, content):
+        fname = f"chapter_{len(self.chapters)+1:05d}.xhtml"
+        with metrics.timed("render"):
+            self.zip.writestr("OEBPS/" + fname,
+                              CHAPTER_XHTML.format(lang=self.lang, title=html.escape(title), body=to_xhtml(content)))
+        self.chapters.append((fname, title))
+
+    def close(self):
+        title = html.escape(self.title)
+        nav_items = "\n".join(f'      <li><a href="{fname}">{html.escape(name)}</a></li>'
+                              for fname, name in self.chapters)
+        nav_points = "\n".join(f'    <navPoint id="nav_{num}" playOrder="{num}"><navLabel><text>{html.escape(name)}</text></navLabel>'
+                               f'<content src="{fname}"/></navPoint>'
+                               for num, (fname, name) in enumerate(self.chapters, 1))
+        items = "\n".join(f'    <item id="ch{num}" href="{fname}" media-type="application/xhtml+xml"/>'
+                          for num, (fname, _) in enumerate(self.chapters, 1))
+        itemrefs = "\n".join(f'    <itemref idref="ch{num}"/>' for num in range(1, len(self.chapters) + 1))
+        modified = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+        self.zip.writestr("OEBPS/nav.xhtml", NAV_XHTML.format(lang=self.lang, title=title, items=nav_items))
+        self.zip.writestr("OEBPS/toc.ncx", TOC_NCX.format(identifier=self.identifier, title=title, points=nav_points))
+        self.zip.writestr("OEBPS/content.opf",
+                          CONTENT_OPF.format(identifier=self.identifier, title=title, lang=self.lang,
+                                             source=html.escape(self.source), modified=modified,
+                                             items=items, itemrefs=itemrefs))
+        self.zip.close()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+# HTML parsing shared by the scrapers.
+# Pages are parsed with the fastest bs4 backend that is installed, and only
+# the part of the page that holds the target element is built into a tree
+# (SoupStrainer). If the target can't be found that way, e.g. because the
+# markup is too broken for the fast parser, the page is parsed again in full
+# with the forgiving fallback backend (html5lib).
+import importlib.util
+
+import bs4
+
+import metrics
+
+#--------   constants   --------
+FAST_BACKENDS = ["lxml", "html.parser"]         # in order of preference
+FALLBACK_BACKEND = "html5lib"
+#--------   /constants  --------
+
+
+def backend_available(backend):
+    if backend == "html.parser":
+        return True
+    return importlib.util.find_spec(backend) is not None
+
+
+def fast_backend():
+    return next(backend for backend in FAST_BACKENDS if backend_available(backend))
+
+
+def parse(html, name=None, attrs=None, check=None, backend=None, fallback=FALLBACK_BACKEND):
+    """
+    Parse html, keeping only the elements matching name/attrs (all of them
+    if name is None). check(soup) decides whether the result is usable; by
+    default, whether the target element was found. When it is not, the whole
+    page is parsed again with the fallback backend.
+    """
+    backend = backend or fast_backend()
+    attrs = attrs or {}
+    # html5lib builds the whole tree regardless
+    strainer = bs4.SoupStrainer(name, attrs) if name and backend != "html5lib" else None
+    if check is None:
+        check = lambda soup: name is None or soup.find(name, attrs) is not None
+
+    with metrics.timed("parse"):
+        soup = bs4.BeautifulSoup(html, backend, parse_only=strainer)
+        if check(soup) or not fallback or fallback == backend or not backend_available(fallback):
+            return soup
+
+        return bs4.BeautifulSoup(html, fallback)
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+# On-disk HTTP response cache shared by all the scrapers.
+# Bodies are stored once per content hash under blobs/, and an sqlite index maps
+# each URL to its blob along with the validators (ETag / Last-Modified) needed to
+# revalidate it. When the blobs grow past the size cap, the least recently used
+# entries are evicted first.
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import requests
+
+#--------   constants   --------
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+                         "useful_scripts", "http")
+MAX_BYTES = 2 * 1024**3                         # 2 GiB
+
+# how long an entry is served without asking the server again, in seconds
+TTL_LIST = 60 * 60                              # chapter lists, manga metadata
+TTL_CHAPTER = 365 * 24 * 60 * 60                # chapter bodies rarely change
+#--------   /constants  --------
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    digest TEXT PRIMARY KEY,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entries (
+    url TEXT PRIMARY KEY,
+    digest TEXT NOT NULL,
+    status INTEGER NOT NULL,
+    encoding TEXT,
+    headers TEXT NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    fetched_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed_at);
+CREATE INDEX IF NOT EXISTS entries_digest ON entries (digest);
+"""
+
+
+def body_encoding(resp):
+    """
+    The declared charset, or a detected one for text; None for images and other binary bodies
+    """
+    if resp.encoding:
+        return resp.encoding
+    content_type = resp.headers.get("Content-Type", "").lower()
+    if content_type.startswith("text/") or "html" in content_type:
+        return resp.apparent_encoding
+    return None
+
+
+class CachedResponse:
+    """
+    The parts of requests.Response that the scrapers use, rebuilt from the cache
+    """
+
+    def __init__(self, url, status_code, content, encoding, headers):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.encoding = encoding
+        self.headers = headers
+        self.from_cache = True
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or "utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class HTTPCache:
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=MAX_BYTES, enabled=True):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.db = None
+
+    def _connect(self):
+        if self.db is None:
+            os.makedirs(os.path.join(self.directory, "blobs"), exist_ok=True)
+            self.db = sqlite3.connect(os.path.join(self.directory, "index.sqlite"),
+                                      timeout=30, check_same_thread=False)
+            self.db.executescript(SCHEMA)
+        return self.db
+
+    def _blob_path(self, digest):
+        return os.path.join(self.directory, "blobs", digest[:2], digest)
+
+    def _lookup(self, url):
+        with self.lock:
+            db = self._connect()
+            return db.execute("SELECT digest, status, encoding, headers, etag, last_modified, fetched_at "
+                              "FROM entries WHERE url = ?", (url,)).fetchone()
+
+    def _load(self, url, row):
+        digest, status, encoding, headers = row[:4]
+        try:
+            with open(self._blob_path(digest), "rb") as f:
+                content = f.read()
+        except FileNotFoundError:
+            return None
+
+        with self.lock:
+            self.db.execute("UPDATE entries SET accessed_at = ? WHERE url = ?", (time.time(), url))
+            self.db.commit()
+        return CachedResponse(url, status, content, encoding, json.loads(headers))
+
+    def _touch(self, url):
+        now = time.time()
+        with self.lock:
+            self.db.execute("UPDATE entries SET fetched_at = ?, accessed_at = ? WHERE url = ?", (now, now, url))
+            self.db.commit()
+
+    def _store(self, url, resp):
+        content = resp.content
+        digest = hashlib.sha256(content).hexdigest()
+        path = self._blob_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(content)
+            os.replace(tmp, path)
+
+        headers = {k: v for k, v in resp.headers.items() if k.lower() == "content-type"}
+        now = time.time()
+        with self.lock:
+            previous = self.db.execute("SELECT digest FROM entries WHERE url = ?", (url,)).fetchone()
+            self.db.execute("INSERT OR IGNORE INTO blobs (digest, size) VALUES (?, ?)", (digest, len(content)))
+            self.db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            (url, digest, resp.status_code, body_encoding(resp),
+                             json.dumps(headers), resp.headers.get("ETag"),
+                             resp.headers.get("Last-Modified"), now, now))
+            # the page changed: its old body goes unless another URL has the same one
+            if previous and previous[0] != digest:
+                self._drop_blob(previous[0])
+            self.db.commit()
+            self._evict()
+
+    def _drop_blob(self, digest):
+        """
+        Delete the blob and its file if no entry refers to it any more.
+        Returns the bytes freed. Caller must hold the lock.
+        """
+        if self.db.execute("SELECT 1 FROM entries WHERE digest = ?", (digest,)).fetchone():
+            return 0
+        row = self.db.execute("SELECT size FROM blobs WHERE digest = ?", (digest,)).fetchone()
+        self.db.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+        try:
+            os.remove(self._blob_path(digest))
+        except FileNotFoundError:
+            pass
+        return row[0] if row else 0
+
+    def _evict(self):
+        """
+        Drop least recently used entries until the blobs fit under max_bytes.
+        A blob is deleted once no entry refers to it any more.
+        Caller must hold the lock.
+        """
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        # blobs left behind by entries that were replaced go first
+        orphans = self.db.execute("SELECT digest FROM blobs WHERE digest NOT IN (SELECT digest FROM entries)")
+        for (digest,) in orphans.fetchall():
+            total -= self._drop_blob(digest)
+
+        victims = self.db.execute("SELECT url, digest FROM entries ORDER BY accessed_at").fetchall()
+        for url, digest in victims:
+            if total <= self.max_bytes:
+                break
+            self.db.execute("DELETE FROM entries WHERE url = ?", (url,))
+            total -= self._drop_blob(digest)
+        self.db.commit()
+
+    def get(self, url, ttl, getter=requests.get, **kwargs):
+        """
+        Return the response for url, from the cache while it is younger than ttl
+        seconds, otherwise revalidated or refetched through getter (requests.get,
+        a session's get, a cloudscraper, ...). kwargs are passed on to getter.
+        Only successful responses are stored.
+        """
+        if not self.enabled:
+            return getter(url, **kwargs)
+
+        row = self._lookup(url)
+        headers = dict(kwargs.pop("headers", None) or {})
+        if row:
+            etag, last_modified, fetched_at = row[4:]
+            if time.time() - fetched_at < ttl:
+                cached = self._load(url, row)
+                if cached is not None:
+                    return cached
+            else:
+                if etag:
+                    headers["If-None-Match"] = etag
+                if last_modified:
+                    headers["If-Modified-Since"] = last_modified
+
+        resp = getter(url, headers=headers, **kwargs)
+
+        if resp.status_code == 304 and row:
+            cached = self._load(url, row)
+            if cached is not None:
+                self._touch(url)
+                return cached
+            # the blob went missing; ask again without validators
+            for key in ("If-None-Match", "If-Modified-Since"):
+                headers.pop(key, None)
+            resp = getter(url, headers=headers, **kwargs)
+
+        if resp.ok:
+            self._store(url, resp)
+        return resp
+
+
+# the one cache every scraper writes through
+http_cache = HTTPCache()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+# Session factory shared by all the scrapers: keep-alive connection pools per
+# host, default timeouts, and retries with exponential backoff that honour
+# Retry-After.
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+#--------   constants   --------
+POOL_HOSTS = 32                                 # hosts whose connection pools are kept
+POOL_SIZE = 8                                   # connections kept open per host
+TIMEOUT = (10, 60)                              # connect, read (seconds)
+RETRIES = 4
+BACKOFF = 1                                     # waits 1, 2, 4, ... seconds between retries
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+#--------   /constants  --------
+
+
+class PooledAdapter(HTTPAdapter):
+    """
+    HTTPAdapter that applies a default timeout to every request
+    """
+
+    def __init__(self, timeout=TIMEOUT, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().send(request, **kwargs)
+
+
+def tune_adapter(adapter, pool_size, timeout, retry):
+    """
+    Give a session's own adapter (e.g. cloudscraper's CipherSuiteAdapter, which
+    carries the TLS settings that get past Cloudflare) the pools, default
+    timeout and retries of a PooledAdapter, without replacing it
+    """
+    adapter.max_retries = retry
+    # the subclass's init_poolmanager adds its ssl_context again
+    adapter.poolmanager.clear()
+    adapter.init_poolmanager(POOL_HOSTS, pool_size)
+    send = adapter.send
+
+    def send_with_timeout(request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = timeout
+        return send(request, **kwargs)
+    adapter.send = send_with_timeout
+
+
+def configure(session, pool_size=POOL_SIZE, timeout=TIMEOUT, retries=RETRIES, backoff=BACKOFF):
+    """
+    Set up pooled, retrying adapters on an existing session (e.g. a cloudscraper).
+    Plain requests adapters are replaced; custom ones are kept and tuned.
+    """
+    retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=RETRY_STATUSES,
+                  respect_retry_after_header=True, raise_on_status=False)
+    adapter = PooledAdapter(timeout=timeout, pool_connections=POOL_HOSTS, pool_maxsize=pool_size,
+                            max_retries=retry)
+    for prefix in ("http://", "https://"):
+        current = session.adapters.get(prefix)
+        if current is None or type(current) is HTTPAdapter or isinstance(current, PooledAdapter):
+            session.mount(prefix, adapter)
+        else:
+            tune_adapter(current, pool_size, timeout, retry)
+    return session
+
+
+def make_session(headers=None, **kwargs):
+    session = configure(requests.Session(), **kwargs)
+    if headers:
+        session.headers.update(headers)
+    return session
+
+
+def connection_stats(session):
+    """
+    Count requests sent over the session's pools, and how many of them
+    needed a new connection rather than reusing a kept-alive one
+    """
+    new = sent = 0
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            new += pool.num_connections
+            sent += pool.num_requests
+    return {"requests": sent, "new": new, "reused": sent - new}
+
+
+def print_stats(session):
+    stats = connection_stats(session)
+    print(f"Connections: {stats['requests']} requests, {stats['new']} new, {stats['reused']} reused")
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+# Per-chapter .cbz archives for the manga downloaders (--format cbz).
+# Each downloaded image goes from memory straight into the chapter's zip,
+# stored rather than deflated since JPEG/PNG/WebP don't compress any
+# further, and ComicInfo.xml is added when the chapter is closed. Nothing
+# but the archive itself is written to disk.
+import mimetypes
+import os
+import threading
+import zipfile
+import xml.etree.ElementTree as ET
+
+#--------   constants   --------
+EXTENSION = ".cbz"
+PAGE_FORMAT = "{:04d}{}"                        # zero-padded, so readers sort pages correctly
+COMICINFO = "ComicInfo.xml"
+#--------   /constants  --------
+
+
+def page_name(idx, ext):
+    return PAGE_FORMAT.format(idx + 1, ext)
+
+
+def image_extension(content_type, default=".jpg"):
+    ext = mimetypes.guess_extension(content_type.split(";")[0].strip())
+    return ".jpg" if ext in (".jpe", ".jpeg") else ext or default
+
+
+def comic_info(pages, **fields):
+    """
+    ComicInfo.xml (the ComicRack schema) for a chapter; empty fields are left out
+    """
+    root = ET.Element("ComicInfo")
+    for key, value in fields.items():
+        if value not in (None, ""):
+            ET.SubElement(root, key).text = str(value)
+    ET.SubElement(root, "PageCount").text = str(pages)
+    ET.SubElement(root, "Manga").text = "Yes"
+    return ET.tostring(root, encoding="utf-8", xml_declaration=True)
+
+
+class CbzWriter:
+    """
+    Zip archive for one chapter. add() can be called from several download
+    threads at once. The archive is written as <path>.part and only renamed
+    to <path> by close(), so an interrupted chapter never looks complete.
+
+    The keyword arguments become ComicInfo fields, e.g. Title, Series, Number, Volume, Web.
+    """
+
+    def __init__(self, path, **info):
+        self.path = path
+        self.info = info
+        self.pages = 0
+        self.lock = threading.Lock()
+        self.zip = zipfile.ZipFile(path + ".part", "w", zipfile.ZIP_STORED)
+
+    def add(self, name, data):
+        with self.lock:
+            self.zip.writestr(name, data)
+            self.pages += 1
+
+    def close(self):
+        with self.lock:
+            self.zip.writestr(COMICINFO, comic_info(self.pages, **self.info))
+            self.zip.close()
+        os.replace(self.path + ".part", self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.zip.close()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+# Content-addressed store for downloaded pages (--image-store DIR).
+# Every image is saved once under DIR/blobs/<sha256[:2]>/<sha256>; chapter
+# folders get hardlinks to the blobs, so the scanlator credits and banners
+# that end every chapter take up space once. Hashes listed in DIR/junk.txt
+# are not saved at all.
+#
+#   python imagestore.py Swot_Manga/.images top          most shared images
+#   python imagestore.py Swot_Manga/.images junk 1/19.png 1/20.png
+import argparse
+import hashlib
+import os
+import shutil
+import sys
+import threading
+
+#--------   constants   --------
+BLOB_DIR = "blobs"
+JUNK_FILE = "junk.txt"
+TOP_BLOBS = 20
+#--------   /constants  --------
+
+
+def file_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class ImageStore:
+    """
+    Downloaders write pages through save(). With directory=None the store is
+    disabled and save() simply writes the file, so callers don't have to check.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = os.path.abspath(directory) if directory else None
+        self.lock = threading.Lock()
+        self.junk = set()
+        self.written = self.linked = self.skipped = 0
+        self.bytes_saved = 0
+        if self.directory:
+            os.makedirs(os.path.join(self.directory, BLOB_DIR), exist_ok=True)
+            self.junk = self.load_junk()
+
+    @property
+    def enabled(self):
+        return self.directory is not None
+
+    def load_junk(self):
+        fname = os.path.join(self.directory, JUNK_FILE)
+        if not os.path.exists(fname):
+            return set()
+        with open(fname) as f:
+            return {line.split()[0] for line in f if line.strip() and not line.startswith("#")}
+
+    def blob_path(self, digest):
+        return os.path.join(self.directory, BLOB_DIR, digest[:2], digest)
+
+    def is_junk(self, data):
+        """
+        True (and counted as skipped) if data is a known-junk image
+        """
+        if not self.junk or hashlib.sha256(data).hexdigest() not in self.junk:
+            return False
+        self._skip(data)
+        return True
+
+    def _skip(self, data):
+        with self.lock:
+            self.skipped += 1
+            self.bytes_saved += len(data)
+
+    def save(self, source, path):
+        """
+        Save an image (bytes, or a file object such as a response's raw stream)
+        to path. Returns path, or None if the image is junk and was skipped.
+        """
+        if not self.enabled:
+            with open(path, "wb") as f:
+                if isinstance(source, bytes):
+                    f.write(source)
+                else:
+                    shutil.copyfileobj(source, f)
+            return path
+
+        data = source if isinstance(source, bytes) else source.read()
+        digest = hashlib.sha256(data).hexdigest()
+        if digest in self.junk:
+            self._skip(data)
+            return None
+
+        blob = self.blob_path(digest)
+        known = os.path.exists(blob)
+        if not known:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            tmp = f"{blob}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, blob)
+
+        if os.path.lexists(path):
+            os.remove(path)
+        try:
+            os.link(blob, path)
+        except OSError:
+            # no hardlinks here (other filesystem, FAT, ...); keep a plain copy
+            shutil.copyfile(blob, path)
+
+        with self.lock:
+            if known:
+                self.linked += 1
+                self.bytes_saved += len(data)
+            else:
+                self.written += 1
+        return path
+
+    def report(self):
+        if not self.enabled:
+            return ""
+        return (f"Image store: {self.written} new, {self.linked} deduplicated, {self.skipped} junk skipped, "
+                f"{self.bytes_saved / 1024**2:.1f} MB saved")
+
+
+def top_blobs(directory, count=TOP_BLOBS):
+    """
+    The blobs with the most hardlinks, i.e. the images repeated in the most chapters
+    """
+    blobs = []
+    for dirpath, _, filenames in os.walk(os.path.join(directory, BLOB_DIR)):
+        for name in filenames:
+            st = os.stat(os.path.join(dirpath, name))
+            blobs.append((st.st_nlink - 1, st.st_size, name))
+    blobs.sort(reverse=True)
+    return blobs[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("store", help="The image store directory (--image-store of the downloaders)")
+    parser.add_argument("command", choices=["top", "junk"],
+                        help="top: list the most repeated images; junk: never save the given images again")
+    parser.add_argument("images", nargs="*", help="Image files to mark as junk")
+    args = parser.parse_args()
+
+    if not os.path.isdir(os.path.join(args.store, BLOB_DIR)):
+        print("Not an image store:", args.store)
+        sys.exit(1)
+
+    if args.command == "top":
+        for links, size, digest in top_blobs(args.store):
+            print(f"{links:>6} copies  {size / 1024:>8.1f} KB  {digest}")
+        return
+
+    with open(os.path.join(args.store, JUNK_FILE), "a") as f:
+        for image in args.images:
+            f.write(f"{file_hash(image)}  {image}\n")
+    print(f"Marked {len(args.images)} images as junk")
+
+
+if __name__ == '__main__':
+    main()
@@ -11,12 +11,28 @@
 import argparse
 from selenium import webdriver
 from selenium.webdriver.common.by import By
+from selenium.common.exceptions import WebDriverException
 import sys, os, time
 from PIL import Image
 import base64
 from io import BytesIO
 import datetime
 import sys
+import mimetypes
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+import requests
+
+# shared helpers (httpsession, scrapeutil, ...) live in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import httpsession
+import scrapeutil
+import transcode
+import cbz
+import imagestore
+import metrics
 
 #-- BEGIN DEBUGTOOL --
 DEBUG = True
@@ -33,13 +49,57 @@ URL_ALT = "https://manga{0}.com/{1}"    # for manga named read-{hash}
 URL_ALT2 = "https://{0}.com/{1}"        # for readmanganato
 USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64; rv:87.0) Gecko/20100101 Firefox/87.0"
 
-WAIT_TIME = 0.7                         # wait 700 msec between images
-WAIT_CHAP = 5                           # wait 5 sec between chapters
+CHAPTER_RATE = 0.2                      # chapter pages per second to start with (one every 5 sec)
+MAX_CHAPTER_RATE = 1                    # the adaptive rates never go above these
+THROTTLED_TITLES = ["Too Many Requests", "Service Unavailable"]
 ERROR_STRING = "ERR404"
 CDN_DOMAINS = ['blogspot', 'mpcdn', 'mgimgcdn', 'mkklcdn']
 FILTER_DOMAIN_STRINGS = ['avt.']         # probably downloads avatars; ignore these images
 DIV_NAMES = ["panel-story-chapter-list"]
 
+DIRECT_WORKERS = 4                      # concurrent direct image downloads
+DIRECT_RATE = 5                         # image requests (or screenshots) per second, per CDN host, to start with
+MAX_DIRECT_RATE = 10
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.webp', '.gif']
+MAX_ATTEMPTS = 3                        # tries per chapter when a browser crashes
+BATCH_TIMEOUT = 120                     # seconds allowed for the in-page batch script
+
+# Runs in the chapter page: collects the qualifying <img>s, waits for them to
+# decode, and hands back every image as a data: URL (fetched, or drawn on a
+# canvas if fetch is blocked) - or null where neither works.
+BATCH_JS = """
+const [cdnDomains, filterStrings] = arguments;
+const done = arguments[arguments.length - 1];
+const images = Array.from(document.images).filter(img =>
+    cdnDomains.some(d => img.src.includes(d)) && !filterStrings.some(f => img.src.includes(f)));
+
+const readBlob = blob => new Promise((resolve, reject) => {
+    const reader = new FileReader();
+    reader.onload = () => resolve(reader.result);
+    reader.onerror = reject;
+    reader.readAsDataURL(blob);
+});
+
+async function grab(img) {
+    try { await img.decode(); } catch (e) {}
+    try {
+        const resp = await fetch(img.src, {credentials: "include"});
+        if (resp.ok) return await readBlob(await resp.blob());
+    } catch (e) {}
+    try {
+        const canvas = document.createElement("canvas");
+        canvas.width = img.naturalWidth;
+        canvas.height = img.naturalHeight;
+        canvas.getContext("2d").drawImage(img, 0, 0);
+        return canvas.toDataURL("image/png");       // throws if the image is cross-origin
+    } catch (e) {
+        return null;
+    }
+}
+
+Promise.all(images.map(grab)).then(done, () => done([]));
+"""
+
 #-- END CONSTANTS --
 
 #-- BEGIN OBJECTS --
@@ -50,16 +110,146 @@ parser.add_argument("fname", help="Name of folder to save chapters in")
 parser.add_argument("--cstart", help="Chapter index to start with. Inclusive")
 parser.add_argument("--cstop", help="Chapter index to stop at. Inclusive")
 parser.add_argument('--clist', help='Comma-separated chapter list', type=str)
+parser.add_argument("--direct", action="store_true",
+                    help="Download the original image files with the browser's cookies instead of taking screenshots")
+parser.add_argument("--workers", type=int, default=DIRECT_WORKERS, help="Concurrent direct image downloads")
+parser.add_argument("--batch-js", action="store_true",
+                    help="Pull all of a chapter's images out of the page with one injected script")
+parser.add_argument("--browsers", type=int, default=1,
+                    help="Download chapters in parallel with this many headless browsers")
+parser.add_argument("--transcode", choices=transcode.FORMATS.keys(),
+                    help="Convert the PNG pages to this format while downloading")
+parser.add_argument("--quality", type=int, default=transcode.QUALITY, help="Quality for --transcode")
+parser.add_argument("--format", choices=["dir", "cbz"], default="dir",
+                    help="Save each chapter as a directory of images, or as one .cbz archive")
+parser.add_argument("--image-store", help="Deduplicate images through this content-addressed store")
+parser.add_argument("--metrics", help="Export Prometheus metrics to this file (and a JSON run summary next to it)")
+parser.add_argument("--fixed-rate", action="store_true",
+                    help="Keep the starting request rates instead of adapting them to the site's responses")
 prog_args = parser.parse_args()
+if prog_args.transcode and prog_args.format == "cbz":
+    parser.error("--transcode works on image files; it can't be combined with --format cbz")
+if prog_args.transcode and prog_args.image_store:
+    # converting replaces the hardlinked pages with unlinked copies, leaving the blobs unused
+    parser.error("--transcode can't be combined with --image-store")
+# started before metrics' export thread, the browser and the download threads, see transcode.Transcoder
+transcoder = transcode.Transcoder(prog_args.transcode, prog_args.quality)
+image_store = imagestore.ImageStore(prog_args.image_store)
+metrics.configure(prog_args.metrics)
 
 #another alternative method that didn't work
 #fire_prof.set_preference("browser.helperApps.neverAsk.saveToDisk", "image/jpeg, image/png, image/webp")
 
-profile = webdriver.FirefoxProfile()
-profile.set_preference("general.useragent.override", USER_AGENT)
-driver = webdriver.Firefox(profile)
+def make_driver(headless=False):
+    profile = webdriver.FirefoxProfile()
+    profile.set_preference("general.useragent.override", USER_AGENT)
+    options = webdriver.FirefoxOptions()
+    options.profile = profile
+    if headless:
+        options.add_argument("-headless")
+    return webdriver.Firefox(options=options)
+
+driver = make_driver()
+
+session = httpsession.make_session()
+# per-host rates, adapted to the responses and remembered across runs
+rate_limiter = scrapeutil.AdaptiveRateLimiter(DIRECT_RATE, MAX_DIRECT_RATE, scrapeutil.RATE_STATE_PATH)
+chapter_limiter = scrapeutil.AdaptiveRateLimiter(CHAPTER_RATE, MAX_CHAPTER_RATE, scrapeutil.RATE_STATE_PATH)
+if prog_args.fixed_rate:
+    rate_limiter.set_rate(DIRECT_RATE, adaptive=False)
+    chapter_limiter.set_rate(CHAPTER_RATE, adaptive=False)
 #-- END OBJECTS --
 
+#-- BEGIN HELPERS --
+def sync_session(driver, session):
+    """
+    Copy the browser's cookies (with the cloudflare clearance) and user agent into the HTTP session
+    """
+    session.headers["User-Agent"] = driver.execute_script("return navigator.userAgent;")
+    for cookie in driver.get_cookies():
+        session.cookies.set(cookie["name"], cookie["value"], domain=cookie.get("domain"), path=cookie.get("path", "/"))
+
+
+def image_extension(source, resp):
+    ext = os.path.splitext(urlparse(source).path)[1].lower()
+    if ext in IMAGE_EXTENSIONS:
+        return ext
+    return mimetypes.guess_extension(resp.headers.get("Content-Type", "").split(";")[0]) or ".jpg"
+
+
+def save_page(archive, chapter_path, idx, ext, data):
+    """
+    Write one page's bytes to <chapter_path>/<idx+1><ext>, or into the chapter's archive
+    """
+    if archive:
+        if not image_store.is_junk(data):
+            with metrics.timed("disk_write") as timing:
+                archive.add(cbz.page_name(idx, ext), data)
+                timing.bytes = len(data)
+        return True
+    path = os.path.join(chapter_path, str(idx+1) + ext)
+    with metrics.timed("disk_write") as timing:
+        saved = image_store.save(data, path)
+        timing.bytes = len(data) if saved else 0
+    if saved:
+        transcoder.submit(os.path.abspath(path))
+    return path
+
+
+def download_image(session, source, chapter_path, idx, referer, archive=None):
+    """
+    Save the original image bytes to <chapter_path>/<idx+1><ext> and return the path
+    (or into the chapter's archive).
+    Returns None if the CDN refuses to hand out the image.
+    """
+    get = rate_limiter.limit(metrics.instrument(session.get, "image_fetch"))
+    try:
+        resp = get(source, headers={"Referer": referer}, stream=True)
+    except requests.RequestException:
+        return None
+
+    if resp.status_code != 200 or not resp.headers.get("Content-Type", "").startswith("image/"):
+        resp.close()
+        return None
+
+    if archive:
+        if not image_store.is_junk(resp.content):
+            with metrics.timed("disk_write") as timing:
+                archive.add(cbz.page_name(idx, image_extension(source, resp)), resp.content)
+                timing.bytes = len(resp.content)
+        return True
+
+    path = os.path.join(chapter_path, str(idx+1)) + image_extension(source, resp)
+    resp.raw.decode_content = True
+    with metrics.timed("disk_write") as timing:
+        saved = image_store.save(resp.raw, path)
+        timing.bytes = os.path.getsize(path) if saved else 0
+    if saved:
+        transcoder.submit(os.path.abspath(path))
+    return path
+
+
+def save_data_url(data_url, chapter_path, idx, archive=None):
+    header, _, payload = data_url.partition(",")
+    mime = header[len("data:"):].split(";")[0]
+    return save_page(archive, chapter_path, idx, mimetypes.guess_extension(mime) or ".png", base64.b64decode(payload))
+
+
+def save_batch(driver, chapter_path, archive=None):
+    """
+    Fetch all of the chapter's images in one WebDriver call and write them
+    out in parallel. Returns the indices of images the page could not hand over.
+    """
+    driver.set_script_timeout(BATCH_TIMEOUT)
+    images = driver.execute_async_script(BATCH_JS, CDN_DOMAINS, FILTER_DOMAIN_STRINGS)
+
+    found = [(data, chapter_path, idx, archive) for idx, data in enumerate(images) if data]
+    with ThreadPoolExecutor(max_workers=prog_args.workers) as executor:
+        list(executor.map(lambda job: save_data_url(*job), found))
+
+    return [idx for idx, data in enumerate(images) if not data]
+#-- END HELPERS --
+
 
 #-- BEGIN MAIN --
 domain_name = prog_args.domain   #"nelo" if prog_args.domain == "nelo" else "kakalot"
@@ -75,7 +265,8 @@ if domain_name == "nato":
     full_url = URL_ALT2.format("readmanganato", prog_args.mname)
 
 print("...Downloading webpage...", full_url)
-driver.get(full_url)
+with metrics.timed("list_fetch", urlparse(full_url).netloc):
+    driver.get(full_url)
 
 if "404" in driver.title:
     print(ERROR_STRING)
@@ -153,47 +344,151 @@ fname = prog_args.fname
 if not os.path.exists(fname):
     os.mkdir(fname)
 
-for chap_index in chap_index_list:
-    
+def download_chapter(driver, session, chap_index):
+    """
+    Save one chapter with the given browser. Returns False if the chapter page is a 404.
+    """
     print("Downloading Chapter indexed {0}...".format(chap_index))
     url = chapter_urls[chap_index]
     chapter_name = chapter_names[chap_index]
 
     # create path
     chapter_path = os.path.join(fname, chapter_name)
-    if not os.path.exists(chapter_path):
-        os.makedirs(chapter_path)
-    
-    driver.get(url)
+    if prog_args.format != "cbz":
+        os.makedirs(chapter_path, exist_ok=True)
 
-    if "404" in driver.title:
-        print(ERROR_STRING)
-        driver.quit()
-        sys.exit()
+    chapter_limiter.wait(url)
+    start = time.perf_counter()
+    with metrics.timed("page_fetch", urlparse(url).netloc):
+        driver.get(url)
+    # the browser doesn't tell the status code; a throttled site says so in the title
+    throttled = any(text in driver.title for text in THROTTLED_TITLES)
+    chapter_limiter.feedback(url, 429 if throttled else 200, time.perf_counter() - start)
 
+    if "404" in driver.title:
+        return False
+
+    if prog_args.format != "cbz":
+        save_chapter_images(driver, session, url, chapter_path)
+        return True
+
+    # a browser crash leaves only the .part file behind
+    with cbz.CbzWriter(chapter_path + cbz.EXTENSION, Title=chapter_name, Series=prog_args.mname,
+                       Number=chap_index + 1, Web=url) as archive:
+        save_chapter_images(driver, session, url, chapter_path, archive)
+    return True
+
+
+def save_chapter_images(driver, session, url, chapter_path, archive=None):
+    """
+    Save the images of the chapter open in the browser: in-page batch, direct download, screenshots
+    """
+    to_screenshot = None
+    if prog_args.batch_js:
+        to_screenshot = save_batch(driver, chapter_path, archive)
+        if not to_screenshot:
+            return
+        dprint(f"{len(to_screenshot)} images could not be read in the page")
 
     # Then, get image links
     image_elems = driver.find_elements(By.TAG_NAME, 'img')
 
     # Check for correct domain
     final_elems= []
+    final_sources = []
     for elem in image_elems:
         source = elem.get_attribute("src")
         conditionals = [domain_str in source for domain_str in CDN_DOMAINS]
         filters = [domain_str in source for domain_str in FILTER_DOMAIN_STRINGS]
         if any(conditionals) and not any(filters):
             final_elems.append(elem)
-    
-    for idx, image_elem in enumerate(final_elems):
-        path = os.path.join(chapter_path, f"{idx+1}.png")
-        scrn = image_elem.screenshot_as_png
-        with open(path, "wb") as f:
-            f.write(scrn)
-
-        time.sleep(WAIT_TIME)
-    time.sleep(WAIT_CHAP)
-
-driver.close()
+            final_sources.append(source)
+
+    # the browser is only needed for the pages; images are fetched directly
+    if to_screenshot is None:
+        to_screenshot = range(len(final_elems))
+    if prog_args.direct:
+        sync_session(driver, session)
+        fetch = lambda idx: download_image(session, final_sources[idx], chapter_path, idx, url, archive)
+        with ThreadPoolExecutor(max_workers=prog_args.workers) as executor:
+            saved = list(executor.map(fetch, to_screenshot))
+        to_screenshot = [idx for idx, ok in zip(to_screenshot, saved) if not ok]
+        if to_screenshot:
+            dprint(f"{len(to_screenshot)} images refused direct download; taking screenshots")
+
+    for idx in to_screenshot:
+        # scrolling to an image makes the page load it from the CDN
+        rate_limiter.wait(final_sources[idx])
+        start = time.perf_counter()
+        image_elem = final_elems[idx]
+        save_page(archive, chapter_path, idx, ".png", image_elem.screenshot_as_png)
+        rate_limiter.feedback(final_sources[idx], latency=time.perf_counter() - start)
+
+
+def quit_quietly(browser):
+    if browser is None:
+        return
+    try:
+        browser.quit()
+    except WebDriverException:
+        pass
+
+
+def chapter_worker(jobs, worker_num):
+    """
+    A headless browser that takes chapter indices off the shared queue.
+    If the browser dies, it is replaced and the chapter is tried again.
+    """
+    browser = None
+    own_session = httpsession.make_session()
+    while True:
+        try:
+            chap_index = jobs.get_nowait()
+        except queue.Empty:
+            break
+
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            try:
+                if browser is None:
+                    browser = make_driver(headless=True)
+                if not download_chapter(browser, own_session, chap_index):
+                    print(f"[browser {worker_num}] {ERROR_STRING}: chapter indexed {chap_index}")
+                break
+            except WebDriverException as exc:
+                print(f"[browser {worker_num}] crashed on chapter indexed {chap_index} (attempt {attempt}): {exc.msg}")
+                quit_quietly(browser)
+                browser = None
+
+    quit_quietly(browser)
+
+
+if prog_args.browsers > 1:
+    # the visible browser was only needed for the chapter list
+    driver.quit()
+    jobs = queue.Queue()
+    for chap_index in chap_index_list:
+        jobs.put(chap_index)
+
+    workers = [threading.Thread(target=chapter_worker, args=(jobs, num+1)) for num in range(prog_args.browsers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+else:
+    for chap_index in chap_index_list:
+        if not download_chapter(driver, session, chap_index):
+            print(ERROR_STRING)
+            driver.quit()
+            transcoder.close()
+            sys.exit()
+
+    driver.close()
+
+converted = transcoder.close()
+if converted:
+    print(f"Converted {converted} images to {prog_args.transcode}")
+if image_store.enabled:
+    print(image_store.report())
 
 if METADATA:
     with open(os.path.join(fname, "info.txt"), "w") as f:
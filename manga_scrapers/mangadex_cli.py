@@ -2,13 +2,25 @@
 
 import argparse
 import json
-import os, shutil, sys
+import os, sys, threading
 import requests
-import itertools, operator
+from concurrent.futures import ThreadPoolExecutor
+
+# shared helpers (httpcache, scrapeutil, ...) live in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import httpcache
+import httpsession
+import scrapeutil
+import transcode
+import cbz
+import imagestore
+import mangadex_index
+import metrics
 
 BASE_URL = 'https://mangadex.org/api/{}'
 BASE_URL_MANGA = BASE_URL.format('manga/{}')
 BASE_URL_CHAPTER = BASE_URL.format('chapter/{}')
+FALLBACK_SERVERS = ['https://mangadex.org/data/']     # tried after the chapter's own servers
 
 ALLOWED_LANGS = ('English',)
 CHAP_ID_FORMAT = 'Vol_{}_Ch_{}__'
@@ -16,6 +28,20 @@ DISALLOWED_CHARS = " :?'!/"
 REPLACEMENT_CHAR = "_"
 
 LANG_MAP = {'English': 'ENG'}
+
+CHAPTER_WORKERS = 2             # chapters downloaded at once
+IMAGE_WORKERS = 4               # image downloads per chapter
+PER_SERVER = 4                  # image downloads in flight per image server
+IMAGE_TIMEOUT = (5, 20)         # a server slower than this is given up on for the page
+IMAGE_RETRIES = 1               # the other servers are tried instead
+MAX_SERVER_FAILURES = 3         # after this many, a server is tried last
+
+session = httpsession.make_session()
+image_session = httpsession.make_session(timeout=IMAGE_TIMEOUT, retries=IMAGE_RETRIES)
+server_limiter = scrapeutil.HostConcurrencyLimiter(PER_SERVER)
+transcoder = transcode.Transcoder()       # replaced in main() with --transcode
+image_store = imagestore.ImageStore()     # replaced in main() with --image-store
+
 def map_language(lang):
     if lang in LANG_MAP.keys():
         return LANG_MAP[lang]
@@ -25,50 +51,114 @@ def filter_title(title):
     new_title = ''.join(char if char not in DISALLOWED_CHARS else REPLACEMENT_CHAR for char in title)
     return new_title
 
-def download_chapter(lang, chapter_id):
+
+class ImageServers:
+    """
+    Counts the failures of each image server, so that the pages still to
+    download go to a healthy server first
+    """
+
+    def __init__(self):
+        self.failures = {}
+        self.lock = threading.Lock()
+
+    def order(self, servers):
+        with self.lock:
+            return sorted(servers, key=lambda server: self.failures.get(server, 0) >= MAX_SERVER_FAILURES)
+
+    def failed(self, server):
+        with self.lock:
+            self.failures[server] = self.failures.get(server, 0) + 1
+
+image_servers = ImageServers()
+
+
+def chapter_servers(chapter_data):
+    servers = [chapter_data['server'], chapter_data.get('server_fallback')] + FALLBACK_SERVERS
+    return [server for idx, server in enumerate(servers) if server and server not in servers[:idx]]
+
+def fetch_image(servers, hash_, page_fname):
+    """
+    Download one page from the first server that delivers it; returns its bytes or None
+    """
+    limited_get = server_limiter.limit(metrics.instrument(image_session.get, "image_fetch"))
+    for server in image_servers.order(servers):
+        try:
+            resp = limited_get(server + hash_ + '/' + page_fname)
+        except requests.RequestException:
+            image_servers.failed(server)
+            continue
+        if resp.status_code == 200:
+            return resp.content
+        image_servers.failed(server)
+    return None
+
+def save_page(data, dirname, page_no, page_fname, archive):
+    if archive:
+        if not image_store.is_junk(data):
+            with metrics.timed("disk_write") as timing:
+                archive.add(cbz.page_name(page_no, os.path.splitext(page_fname)[1]), data)
+                timing.bytes = len(data)
+        return
+    fname = os.path.join(dirname, str(page_no + 1) + os.path.splitext(page_fname)[1])
+    with metrics.timed("disk_write") as timing:
+        saved = image_store.save(data, fname)
+        timing.bytes = len(data) if saved else 0
+    if saved:
+        transcoder.submit(os.path.abspath(fname))
+
+def download_chapter(lang, chapter_id, root, fmt='dir', series='', image_workers=IMAGE_WORKERS):
+    """
+    Save one chapter under root, as a directory or a .cbz.
+    Returns (name, pages saved, pages in the chapter), or None if the chapter data can't be had.
+    """
     lang = map_language(lang)
     url_chapter = BASE_URL_CHAPTER.format(chapter_id)
 
-    resp_chapter = requests.get(url_chapter)
+    # short-lived: the image server named in the chapter data rotates
+    resp_chapter = httpcache.http_cache.get(url_chapter, httpcache.TTL_LIST,
+                                           metrics.instrument(session.get, "page_fetch"))
     chapter_data = None
     if resp_chapter.status_code == 200:
         chapter_data = json.loads(resp_chapter.text)
     else:
         print('Failure. Status code: ', resp_chapter.status_code)
         print('Skipping chapter...')
-        return
+        return None
     
     vol_num = chapter_data['volume']
     chap_num = chapter_data['chapter']
     title = chapter_data['title']
 
     hash_ = chapter_data['hash']
-    server_ = chapter_data['server']
+    servers = chapter_servers(chapter_data)
+    pages = chapter_data['page_array']
 
     # make directory
     clean_title = filter_title(title)
     serial_id = CHAP_ID_FORMAT.format(vol_num, chap_num)
-    dirname = '[{}]'.format(lang) + serial_id + clean_title
-    if not os.path.exists(dirname):
-        os.mkdir(dirname)
-    os.chdir(dirname)
-    
-    print("Downloading to ", dirname)
-    page_no = 0
-    for page_fname in chapter_data['page_array']:
-        page_no += 1
-        url = server_ + hash_ + '/' + page_fname
-        ind = page_fname.rindex('.')
-        extension = page_fname[ind:]
-        fname = str(page_no) + extension
-
-        resp = requests.get(url, stream=True)
-        if resp.status_code == 200:
-            with open(fname, 'wb') as f:
-                resp.raw.decode_content = True
-                shutil.copyfileobj(resp.raw, f)
+    dirname = os.path.join(root, '[{}]'.format(lang) + serial_id + clean_title)
+
+    def download(archive=None):
+        def job(page):
+            page_no, page_fname = page
+            data = fetch_image(servers, hash_, page_fname)
+            if data is None:
+                return False
+            save_page(data, dirname, page_no, page_fname, archive)
+            return True
+
+        with ThreadPoolExecutor(max_workers=image_workers) as executor:
+            return sum(executor.map(job, enumerate(pages)))
 
-    os.chdir('..')
+    if fmt == 'cbz':
+        with cbz.CbzWriter(dirname + cbz.EXTENSION, Title=title, Series=series, Number=chap_num,
+                           Volume=vol_num, Web=url_chapter) as archive:
+            saved = download(archive)
+        return os.path.basename(dirname) + cbz.EXTENSION, saved, len(pages)
+
+    os.makedirs(dirname, exist_ok=True)
+    return os.path.basename(dirname), download(), len(pages)
 
 def main():
     parser = argparse.ArgumentParser()
@@ -76,8 +166,36 @@ def main():
     parser.add_argument("dirname", help="directory name to save manga to")
     parser.add_argument("--cstart", help="serial number of starting chapter (count from one)")
     parser.add_argument("--cstop", help="serial number of last chapter")
+    parser.add_argument("--no-cache", action="store_true", help="bypass the shared HTTP cache")
+    parser.add_argument("--transcode", choices=transcode.FORMATS.keys(),
+                        help="convert the pages to this format while downloading")
+    parser.add_argument("--quality", type=int, default=transcode.QUALITY, help="quality for --transcode")
+    parser.add_argument("--format", choices=["dir", "cbz"], default="dir",
+                        help="save each chapter as a directory of images, or as one .cbz archive")
+    parser.add_argument("--image-store", help="deduplicate images through this content-addressed store")
+    parser.add_argument("--chapter-workers", type=int, default=CHAPTER_WORKERS, help="chapters downloaded at once")
+    parser.add_argument("--image-workers", type=int, default=IMAGE_WORKERS, help="image downloads per chapter")
+    parser.add_argument("--per-server", type=int, default=PER_SERVER,
+                        help="image downloads in flight per image server")
+    parser.add_argument("--lang", action="append",
+                        help="chapter language, e.g. English; repeat for several, or 'all' (default: English)")
+    parser.add_argument("--new", action="store_true",
+                        help="only chapters that appeared since the last run (within --cstart/--cstop, if given)")
+    parser.add_argument("--index", default=mangadex_index.INDEX_PATH, help="local metadata index (sqlite)")
+    parser.add_argument("--metrics", help="export Prometheus metrics to this file (and a JSON run summary next to it)")
 
     my_args = parser.parse_args()
+    if my_args.transcode and my_args.format == 'cbz':
+        parser.error("--transcode works on image files; it can't be combined with --format cbz")
+    if my_args.transcode and my_args.image_store:
+        # converting replaces the hardlinked pages with unlinked copies, leaving the blobs unused
+        parser.error("--transcode can't be combined with --image-store")
+    httpcache.http_cache.enabled = not my_args.no_cache
+    metrics.configure(my_args.metrics)
+    global transcoder, image_store
+    transcoder = transcode.Transcoder(my_args.transcode, my_args.quality)
+    image_store = imagestore.ImageStore(my_args.image_store)
+    server_limiter.max_in_flight = my_args.per_server
 
     #Get data
     assert(my_args.id is not None and my_args.dirname is not None)
@@ -87,31 +205,31 @@ def main():
     # make main directory
     if not os.path.exists(manga_dirname):
         os.makedirs(manga_dirname)
-    os.chdir(manga_dirname)
 
+    # bring the local index up to date; the cache turns an unchanged manga into a 304
+    index = mangadex_index.MangaIndex(my_args.index)
     url_manga_mdata = BASE_URL_MANGA.format(manga_id)
-    resp_manga = requests.get(url_manga_mdata)
-    manga_metadata = None
+    resp_manga = httpcache.http_cache.get(url_manga_mdata, httpcache.TTL_LIST,
+                                         metrics.instrument(session.get, "list_fetch"))
+    previous_sync = index.last_sync(int(manga_id))
     if resp_manga.status_code == 200:
-        manga_metadata = json.loads(resp_manga.text)
+        previous_sync = index.refresh(int(manga_id), resp_manga.text)
+    elif index.has(int(manga_id)):
+        print('Failure. Status code: ', resp_manga.status_code)
+        print('Using the chapter list from the last refresh...')
     else:
         print('Failure. Status code: ', resp_manga.status_code)
         #os.quit()
         sys.exit()
-    
-    chapter_list = []
-
-    # get chapters in preferred language
-    for chapter_key in manga_metadata['chapter'].keys():
-        chapter = manga_metadata['chapter'][chapter_key]
-        if chapter['lang_name'] in ALLOWED_LANGS:
-            chapter_info = (chapter['lang_name'], chapter_key)
-            chapter_list.append(chapter_info)
-    
-    #if no starting range is specified, ask for it
+
+    languages = my_args.lang or list(ALLOWED_LANGS)
+    if 'all' in languages:
+        languages = index.languages(int(manga_id))
+
+    #if no starting range is specified, ask for it (--new alone means all new chapters)
     start_chap = None
     if my_args.cstart is None:
-        start_x = int(input("Starting chapter: "))
+        start_x = 1 if my_args.new else int(input("Starting chapter: "))
         start_chap = start_x
     else:
         start_chap = int(my_args.cstart)
@@ -119,19 +237,36 @@ def main():
     # if not end range is specified, ask for it
     stop_chap = None
     if my_args.cstop is None:
-        stop_x = int(input("Stopping chapter: "))
+        stop_x = None if my_args.new else int(input("Stopping chapter: "))
         stop_chap = stop_x
     else:
         stop_chap = int(my_args.cstop)
 
+    # one range per language
+    since = previous_sync if my_args.new else None
+    selected = []
+    for lang in languages:
+        selected += index.chapters(int(manga_id), lang, start_chap, stop_chap, since)
+    if my_args.new:
+        print("{} new chapters".format(len(selected)))
+
+    # several chapters at once; each downloads its pages on its own threads
+    series = index.title(int(manga_id))
+    index.close()
+    fetch = lambda chapter: download_chapter(chapter[0], chapter[1], manga_dirname, my_args.format, series,
+                                             my_args.image_workers)
+    for chapter, result in scrapeutil.fetch_in_order(selected, fetch, my_args.chapter_workers):
+        if result:
+            name, saved, total = result
+            print("Downloaded {}/{} pages to {}".format(saved, total, name))
 
-    # group by laanguage
-    for key, group in itertools.groupby(chapter_list, operator.itemgetter(0)):
-        lang_chapters = list(group)
-        lang_chapters.reverse()
-        lang_chapters = lang_chapters[start_chap-1:stop_chap]
-        for chapter in lang_chapters:
-            download_chapter(chapter[0], chapter[1])
+    converted = transcoder.close()
+    if converted:
+        print(f"Converted {converted} images to {my_args.transcode}")
+    if image_store.enabled:
+        print(image_store.report())
+    httpsession.print_stats(session)
+    httpsession.print_stats(image_session)
 
 
 
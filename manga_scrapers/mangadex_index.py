@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+# Local sqlite index of mangadex manga and chapter metadata.
+# mangadex_cli refreshes it from the manga JSON (a revalidated, often 304,
+# response from the shared HTTP cache) and then picks chapters with indexed
+# queries instead of walking the JSON. A refresh only writes the chapters
+# that changed, and remembers in which refresh each chapter first appeared,
+# which is what --new uses.
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+#--------   constants   --------
+INDEX_PATH = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+                          "useful_scripts", "mangadex.sqlite")
+NO_VOLUME = 1e9                                 # chapters without a volume sort after the numbered ones
+#--------   /constants  --------
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS manga (
+    id INTEGER PRIMARY KEY,
+    title TEXT,
+    digest TEXT,
+    last_sync INTEGER
+);
+CREATE TABLE IF NOT EXISTS syncs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    manga_id INTEGER NOT NULL,
+    synced_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chapters (
+    id INTEGER PRIMARY KEY,
+    manga_id INTEGER NOT NULL,
+    lang TEXT NOT NULL,
+    volume TEXT,
+    chapter TEXT,
+    volume_num REAL,
+    chapter_num REAL,
+    title TEXT,
+    timestamp INTEGER,
+    first_sync INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chapters_order ON chapters (manga_id, lang, volume_num, chapter_num);
+CREATE INDEX IF NOT EXISTS chapters_new ON chapters (manga_id, first_sync);
+"""
+
+UPSERT = """
+INSERT INTO chapters (id, manga_id, lang, volume, chapter, volume_num, chapter_num, title, timestamp, first_sync)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (id) DO UPDATE SET
+    lang = excluded.lang, volume = excluded.volume, chapter = excluded.chapter,
+    volume_num = excluded.volume_num, chapter_num = excluded.chapter_num,
+    title = excluded.title, timestamp = excluded.timestamp
+WHERE (lang, volume, chapter, title, timestamp)
+    IS NOT (excluded.lang, excluded.volume, excluded.chapter, excluded.title, excluded.timestamp)
+"""
+
+
+def to_number(value, default=None):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+class MangaIndex:
+
+    def __init__(self, path=INDEX_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.executescript(SCHEMA)
+
+    def has(self, manga_id):
+        return self.db.execute("SELECT 1 FROM manga WHERE id = ?", (manga_id,)).fetchone() is not None
+
+    def last_sync(self, manga_id):
+        row = self.db.execute("SELECT last_sync FROM manga WHERE id = ?", (manga_id,)).fetchone()
+        return row[0] if row and row[0] is not None else 0
+
+    def refresh(self, manga_id, text):
+        """
+        Bring the manga's chapters in line with its metadata JSON. Returns the
+        sync id of the previous refresh: chapters new in this one have a greater
+        first_sync. Unchanged metadata is recognised by its hash and skipped.
+        """
+        previous = self.last_sync(manga_id)
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        row = self.db.execute("SELECT digest FROM manga WHERE id = ?", (manga_id,)).fetchone()
+        if row and row[0] == digest:
+            return previous
+
+        metadata = json.loads(text)
+        with self.db:
+            sync = self.db.execute("INSERT INTO syncs (manga_id, synced_at) VALUES (?, ?)",
+                                   (manga_id, time.time())).lastrowid
+            chapters = metadata.get("chapter", {})
+            self.db.executemany(UPSERT, [
+                (int(key), manga_id, chapter["lang_name"], chapter.get("volume", ""), chapter.get("chapter", ""),
+                 to_number(chapter.get("volume"), NO_VOLUME), to_number(chapter.get("chapter")),
+                 chapter.get("title", ""), chapter.get("timestamp"), sync)
+                for key, chapter in chapters.items()])
+
+            # chapters taken down since the last refresh
+            known = {row[0] for row in self.db.execute("SELECT id FROM chapters WHERE manga_id = ?", (manga_id,))}
+            self.db.executemany("DELETE FROM chapters WHERE id = ?",
+                                [(chapter_id,) for chapter_id in known - {int(key) for key in chapters}])
+
+            self.db.execute("INSERT INTO manga (id, title, digest, last_sync) VALUES (?, ?, ?, ?) "
+                            "ON CONFLICT (id) DO UPDATE SET title = excluded.title, digest = excluded.digest, "
+                            "last_sync = excluded.last_sync",
+                            (manga_id, metadata.get("manga", {}).get("title", ""), digest, sync))
+        return previous
+
+    def title(self, manga_id):
+        row = self.db.execute("SELECT title FROM manga WHERE id = ?", (manga_id,)).fetchone()
+        return row[0] if row else ""
+
+    def languages(self, manga_id):
+        return [row[0] for row in self.db.execute(
+            "SELECT DISTINCT lang FROM chapters WHERE manga_id = ? ORDER BY lang", (manga_id,))]
+
+    def chapters(self, manga_id, lang, start=1, stop=None, since=None):
+        """
+        (lang, chapter id) of the lang chapters in reading order, from serial
+        number start to stop (counting from one, inclusive). With since, only
+        the chapters that first appeared after that sync.
+        """
+        # serial numbers count all of the lang chapters, new or not
+        query = ("SELECT lang, id FROM ("
+                 "  SELECT lang, id, first_sync, ROW_NUMBER() OVER (ORDER BY volume_num, chapter_num, id) AS serial"
+                 "  FROM chapters WHERE manga_id = ? AND lang = ?"
+                 ") WHERE serial >= ?")
+        params = [manga_id, lang, start]
+        if stop is not None:
+            query += " AND serial <= ?"
+            params.append(stop)
+        if since is not None:
+            query += " AND first_sync > ?"
+            params.append(since)
+        query += " ORDER BY serial"
+        return [(row[0], str(row[1])) for row in self.db.execute(query, params)]
+
+    def close(self):
+        self.db.close()
@@ -1,16 +1,25 @@
 #!/usr/bin/env python
 
-import bs4
 import os
 import sys
-import requests
 import argparse
 import logging
 import datetime
-import shutil
-import time
+import re
+import functools
 from dataclasses import dataclass
 
+# shared helpers (httpcache, scrapeutil, ...) live in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import httpcache
+import httpsession
+import htmlparse
+import scrapeutil
+import transcode
+import cbz
+import imagestore
+import metrics
+
 #-------------------------------#
 #  Constants                    #
 #-------------------------------#
@@ -26,7 +35,12 @@ SANITIZATION_MAPPING = {
 }
 
 
-POLITENESS_FACTOR = 0.5     # delay between image downloads (seconds)
+START_RATE = 2              # requests per second to a host without a rate saved by an earlier run
+MAX_RATE = 8                # the adaptive rate never goes above this
+PAGE_WORKERS = 2            # concurrent page html downloads
+PARSE_WORKERS = 1
+IMAGE_WORKERS = 2           # concurrent image downloads
+INFER_FROM_PAGES = 2        # pages scraped to learn the image URL pattern
 
 LOGGER_FILENAME = "mtowndl.log"
 SUPPRESS_STDOUT = False                             # set to True for no printing at all
@@ -43,6 +57,16 @@ class Chapter:
     title: str
     url: str
 
+# per-host rate (site and image CDN), adapted to the responses and remembered across runs;
+# shared by all the workers
+rate_limiter = scrapeutil.AdaptiveRateLimiter(START_RATE, MAX_RATE, scrapeutil.RATE_STATE_PATH)
+session = httpsession.make_session()
+transcoder = transcode.Transcoder()       # replaced in main() with --transcode
+image_store = imagestore.ImageStore()     # replaced in main() with --image-store
+limited_get = rate_limiter.limit(metrics.instrument(session.get, "page_fetch"))
+list_get = rate_limiter.limit(metrics.instrument(session.get, "list_fetch"))
+image_get = rate_limiter.limit(metrics.instrument(session.get, "image_fetch"))
+
 #-------------------------------#
 #  Helper functions             #
 #-------------------------------#
@@ -54,7 +78,7 @@ def build_directory(args):
 def build_chapter_directory(dirname):
     if not os.path.exists(dirname):
         os.makedirs(dirname)
-    os.chdir(dirname)
+    return dirname
 
 
 def sanitize_chapter_title(title):
@@ -64,7 +88,8 @@ def sanitize_chapter_title(title):
     return title
 
 def supply_schema(imgUrl):
-    if "https" not in imgUrl[:6]:
+    # protocol-relative URLs, e.g. //zjcdn.mangahere.org/...
+    if imgUrl.startswith("//"):
         return "https:" + imgUrl
     return imgUrl
 
@@ -78,12 +103,12 @@ def get_chapter_list(args):
     chapterList = []
 
     mangaHomeURL = URL.format_map(dict(mangaName=args.name))
-    resp = requests.get(mangaHomeURL)
+    resp = httpcache.http_cache.get(mangaHomeURL, httpcache.TTL_LIST, list_get)
 
     if not resp.ok:
         return None
     
-    soup = bs4.BeautifulSoup(resp.text, "html.parser")
+    soup = htmlparse.parse(resp.text, "ul", {"class" : LIST_CLASSNAME})
     chapterContainer = soup.find("ul", {"class" : LIST_CLASSNAME})
 
     if not chapterContainer:
@@ -102,15 +127,129 @@ def get_chapter_list(args):
     return chapterList
 
 
-def download_chapter(chapter):
-    
-    resp = requests.get(chapter.url)
+def fetch_page(job):
+    idx, link = job
+    resp = httpcache.http_cache.get(BASE_URL_NS.format(rest=link), httpcache.TTL_CHAPTER, limited_get)
+    if resp.status_code != 200:
+        logging.info(f"\t\t[Could not download page indexed {idx}")
+        return None
+    return idx, resp.text
+
+
+def parse_page(job):
+    idx, html = job
+    soup = htmlparse.parse(html, "img", {"id": IMAGE_ID})
+    imageLink = soup.find("img", {"id": IMAGE_ID})
+    if not imageLink:
+        logging.info(f"\t\t[Could not download page indexed {idx}")
+        return None
+    return idx, supply_schema(imageLink["src"])
+
+
+def save_image(job, verify=False, archive=None, directory="."):
+    """
+    Stream the image to directory/<idx+1>.png, or into archive (a cbz.CbzWriter) if given.
+    With verify, a response that is not an image counts as a failure
+    (for guessed URLs), and nothing is logged.
+    """
+    idx, imageSrc = job
+    respImg = image_get(imageSrc, stream=True)
+    isImage = respImg.headers.get("Content-Type", "").startswith("image/")
+    if respImg.status_code != 200 or (verify and not isImage):
+        respImg.close()
+        if not verify:
+            logging.info(f"\t\t[Could not download page indexed {idx}")
+        return None
+
+    if archive:
+        contentType = respImg.headers.get("Content-Type", "")
+        if not image_store.is_junk(respImg.content):
+            with metrics.timed("disk_write") as timing:
+                archive.add(cbz.page_name(idx, cbz.image_extension(contentType)), respImg.content)
+                timing.bytes = len(respImg.content)
+        return idx
+
+    # save to file
+    imageFname = os.path.join(directory, f"{idx+1}.png")
+    respImg.raw.decode_content = True
+    with metrics.timed("disk_write") as timing:
+        saved = image_store.save(respImg.raw, imageFname)
+        timing.bytes = os.path.getsize(imageFname) if saved else 0
+    if saved:
+        transcoder.submit(os.path.abspath(imageFname))
+    return idx
+
+
+def scrape_page(job, archive=None, directory="."):
+    """
+    Fetch, parse and save one page the slow way, without the pipeline
+    """
+    page = fetch_page(job)
+    if page is None:
+        return None
+    image = parse_page(page)
+    if image is None:
+        return None
+    if save_image(image, archive=archive, directory=directory) is None:
+        return None
+    return image
+
+
+def infer_image_template(first, second):
+    """
+    Given two (idx, imageSrc) pairs, find the single number in the URL that
+    follows the page index, e.g. .../q001.jpg, .../q002.jpg
+    Returns a function idx -> guessed imageSrc, or None if there is no such number.
+    """
+    (idxA, urlA), (idxB, urlB) = first, second
+    partsA = re.split(r"(\d+)", urlA)
+    partsB = re.split(r"(\d+)", urlB)
+    if len(partsA) != len(partsB):
+        return None
+
+    diffs = [pos for pos, (a, b) in enumerate(zip(partsA, partsB)) if a != b]
+    if len(diffs) != 1 or diffs[0] % 2 == 0:            # odd positions hold the numbers
+        return None
+
+    pos = diffs[0]
+    numA, numB = partsA[pos], partsB[pos]
+    if int(numB) - int(numA) != idxB - idxA:
+        return None
+
+    offset = int(numA) - idxA
+    width = len(numA) if len(numA) == len(numB) else 0
+
+    def guess(idx):
+        parts = list(partsA)
+        parts[pos] = str(idx + offset).zfill(width)
+        return "".join(parts)
+    return guess
+
+
+def guess_image(job, template, archive=None, directory="."):
+    idx, link = job
+    if save_image((idx, template(idx)), verify=True, archive=archive, directory=directory) is not None:
+        return idx
+
+    logging.info(f"\t\t[Guessed URL failed for page indexed {idx}; scraping the page")
+    if scrape_page(job, archive, directory) is None:
+        return None
+    return idx
+
+
+def download_chapter(chapter, page_workers=PAGE_WORKERS, image_workers=IMAGE_WORKERS, infer_urls=False,
+                     fmt="dir", series="", root="."):
+    """
+    Save the chapter's pages to a directory named after it under root, or with
+    fmt="cbz" to a single <title>.cbz (no directory, no loose files)
+    """
+    resp = httpcache.http_cache.get(chapter.url, httpcache.TTL_CHAPTER, limited_get)
     if resp.status_code != 200:
         logging.info("...Skipping chapter; bad response")
         return
 
     # get the number of pages from the navigation dropdown
-    soup = bs4.BeautifulSoup(resp.text, "html.parser")
+    soup = htmlparse.parse(resp.text, "div", {"class": "page_select"})
     navBar = soup.find("div", {"class": "page_select"})
     if not navBar:
         logging.info("...Skipping chapter; failed to locate page_select")
@@ -129,58 +268,53 @@ def download_chapter(chapter):
     pageLinks = [ x["value"] for x in options if 'featured' not in x.text.lower() ]
 
     
-    # Create the directory and cd into it
-    build_chapter_directory(chapter.title)
+    archive = None
+    directory = os.path.join(root, chapter.title)
+    if fmt == "cbz":
+        archive = cbz.CbzWriter(directory + cbz.EXTENSION, Title=chapter.title, Series=series,
+                                Number=chapter.index + 1, Web=chapter.url)
+    else:
+        build_chapter_directory(directory)
 
 
     # prepare the progressbar
     numPages = len(pageLinks)
     print_cond_f("[" + " "*(PROGBAR_LEN-2) + "]", end=" ")
 
-    for idx, link in enumerate(pageLinks):
-
-
-        link = BASE_URL_NS.format(rest=link)
-        resp = requests.get(link)
-
-        if resp.status_code != 200:
-            logging.info(f"\t\t[Could not download page indexed {idx}")
-            continue
-        
-        soup = bs4.BeautifulSoup(resp.text, "html.parser")
-        imageLink = soup.find("img", {"id": IMAGE_ID})
-
-        if not imageLink:
-            logging.info(f"\t\t[Could not download page indexed {idx}")
-            continue
-
-        imageSrc = supply_schema(imageLink["src"])
-        
-        respImg = requests.get(imageSrc, stream=True)
-        if respImg.status_code != 200:
-            logging.info(f"\t\t[Could not download page indexed {idx}")
-            continue
-        
-        # save to file
-        imageFname = f"{idx+1}.png"
-        with open(imageFname, "wb") as fi:
-            respImg.raw_decode_content = True
-            shutil.copyfileobj(respImg.raw, fi)
-
-
-        progress = int((idx+1)/numPages * (PROGBAR_LEN-2))
+    jobs = list(enumerate(pageLinks))
+    numDone = 0
+
+    # learn the image URL pattern from the first two pages, then skip the page html
+    template = None
+    if infer_urls and numPages > INFER_FROM_PAGES:
+        learned = [scrape_page(job, archive, directory) for job in jobs[:INFER_FROM_PAGES]]
+        numDone = sum(image is not None for image in learned)
+        if None not in learned:
+            template = infer_image_template(*learned)
+        jobs = jobs[INFER_FROM_PAGES:]
+
+    if template:
+        stages = [(functools.partial(guess_image, template=template, archive=archive, directory=directory),
+                   image_workers)]
+    else:
+        # page html -> image url -> image file; all three stages run at once
+        stages = [
+            (fetch_page, page_workers),
+            (parse_page, PARSE_WORKERS),
+            (functools.partial(save_image, archive=archive, directory=directory), image_workers),
+        ]
+
+    for idx in scrapeutil.run_pipeline(jobs, stages):
+        numDone += 1
+        progress = int(numDone/numPages * (PROGBAR_LEN-2))
         print_cond_f("\r[" + (PROGBAR_ELEM * progress) + (" " * (PROGBAR_LEN - 2 - progress)) + "]", end="")
 
-        # Don't overwhelm the servers;
-        time.sleep(POLITENESS_FACTOR)
-
-
-        
     print_cond_f("\n")
     logging.info(f"...Finished Chapter")
     logging.info("-" * 64)
-    
-    os.chdir("..")
+
+    if archive:
+        archive.close()
 
 def main():
     logging.basicConfig(filename=LOGGER_FILENAME, encoding="utf-8", format='%(message)s', level=logging.INFO)
@@ -193,9 +327,37 @@ def main():
     parser.add_argument("dirname", help="Root folder for the manga. Chapters will be written to this directory")
     parser.add_argument("--cstart", help="Starting chapter, a, in [a,b] (closed interval of integers)")
     parser.add_argument("--cstop", help="Final chapter, b, in [a,b] (closed interval of integers)")
+    parser.add_argument("--no-cache", action="store_true", help="Bypass the shared HTTP cache")
+    parser.add_argument("--page-workers", type=int, default=PAGE_WORKERS, help="Concurrent page downloads")
+    parser.add_argument("--image-workers", type=int, default=IMAGE_WORKERS, help="Concurrent image downloads")
+    parser.add_argument("--infer-urls", action="store_true",
+                        help="Guess image URLs from the first pages instead of fetching every page")
+    parser.add_argument("--rate", type=float, default=MAX_RATE,
+                        help="Max requests per second to a host; the rate adapts below it")
+    parser.add_argument("--fixed-rate", action="store_true",
+                        help="Send exactly --rate requests per second to a host, without adapting")
+    parser.add_argument("--transcode", choices=transcode.FORMATS.keys(),
+                        help="Convert the pages to this format while downloading")
+    parser.add_argument("--quality", type=int, default=transcode.QUALITY, help="Quality for --transcode")
+    parser.add_argument("--format", choices=["dir", "cbz"], default="dir",
+                        help="Save each chapter as a directory of images, or as one .cbz archive")
+    parser.add_argument("--image-store", help="Deduplicate images through this content-addressed store")
+    parser.add_argument("--metrics", help="Export Prometheus metrics to this file (and a JSON run summary next to it)")
 
 
     args = parser.parse_args()
+    if args.transcode and args.format == "cbz":
+        parser.error("--transcode works on image files; it can't be combined with --format cbz")
+    if args.transcode and args.image_store:
+        # converting replaces the hardlinked pages with unlinked copies, leaving the blobs unused
+        parser.error("--transcode can't be combined with --image-store")
+    # started before metrics' export thread and the download threads, see transcode.Transcoder
+    global transcoder, image_store
+    transcoder = transcode.Transcoder(args.transcode, args.quality)
+    image_store = imagestore.ImageStore(args.image_store)
+    httpcache.http_cache.enabled = not args.no_cache
+    rate_limiter.set_rate(args.rate, adaptive=not args.fixed_rate)
+    metrics.configure(args.metrics)
 
     # Validation
     assert(args.name is not None and args.dirname is not None)
@@ -225,7 +387,11 @@ def main():
     for chapter in chapterList[startIndex:stopIndex+1]:
         print_cond_f(f"Downloading chapter {chapter.index+1}...")
         logging.info(f"Downloading chapter {chapter.index} => {chapter.title}")
-        download_chapter(chapter)
+        download_chapter(chapter, args.page_workers, args.image_workers, args.infer_urls, args.format, args.name)
+
+    converted = transcoder.close()
+    if converted:
+        print_cond_f(f"Converted {converted} images to {args.transcode}")
 
     # extra metadata
     if ADD_INFO_FILE:
@@ -239,6 +405,9 @@ def main():
             f.write(stri)
 
 
+    if image_store.enabled:
+        print_cond_f(image_store.report())
+    httpsession.print_stats(session)
     logging.info(f"\n\nSession ended at {datetime.datetime.now().strftime('%c')}\n\n")
     logging.info("="*32 + "\n")
 
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+# Converts downloaded PNG pages to JPEG or WebP on a process pool.
+# Replaces png_to_jpeg.sh: the downloaders hand pages over as they are
+# written (--transcode), and the script can also be run on an existing
+# library:
+#
+#   python transcode.py Swot_Manga --format webp --quality 80
+import argparse
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+#--------   constants   --------
+FORMATS = {"jpeg": ("JPEG", ".jpg"), "webp": ("WEBP", ".webp")}
+QUALITY = 90
+SOURCE_EXTENSIONS = (".png",)
+#--------   /constants  --------
+
+
+def convert_image(path, fmt="jpeg", quality=QUALITY, keep=False):
+    """
+    Convert one image file and return the new path.
+    The result is written next to the source and moved into place atomically, so an
+    interrupted run never leaves half a file behind. Images that are already in the
+    target format (e.g. JPEGs saved as .png) are only renamed.
+    """
+    pil_format, ext = FORMATS[fmt]
+    target = os.path.splitext(path)[0] + ext
+
+    # converted on an earlier run that was stopped before the source was removed
+    if os.path.exists(target):
+        if not keep:
+            os.remove(path)
+        return target
+
+    tmp = target + ".tmp"
+    with Image.open(path) as img:
+        if img.format == pil_format and not keep:
+            os.replace(path, target)
+            return target
+
+        if pil_format == "JPEG" and img.mode not in ("RGB", "L"):
+            # no alpha channel in JPEG; flatten transparent pages onto white
+            rgba = img.convert("RGBA")
+            img = Image.new("RGB", rgba.size, (255, 255, 255))
+            img.paste(rgba, mask=rgba.split()[3])
+        img.save(tmp, pil_format, quality=quality, optimize=True)
+
+    os.replace(tmp, target)
+    if not keep:
+        os.remove(path)
+    return target
+
+
+class Transcoder:
+    """
+    Pool that the downloaders hand finished pages to. With fmt=None every
+    call is a no-op, so callers don't have to check whether it's enabled.
+    """
+
+    def __init__(self, fmt=None, quality=QUALITY, workers=None, keep=False):
+        self.fmt = fmt
+        self.quality = quality
+        self.keep = keep
+        self.futures = []
+        self.executor = None
+        if fmt:
+            # The downloaders submit from their worker threads, so the pool is started
+            # right away: with fork, all workers are created on the first submit, and
+            # this way that happens here, before any of those threads exist.
+            # (spawn would re-run manga_kn_dl's top-level code in every worker.)
+            fork = "fork" in multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("fork") if fork else None
+            self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+            self.executor.submit(int).result()
+
+    def submit(self, path):
+        if self.executor and path.lower().endswith(SOURCE_EXTENSIONS):
+            self.futures.append((path, self.executor.submit(convert_image, path, self.fmt, self.quality, self.keep)))
+
+    def close(self):
+        """
+        Wait for the submitted pages; returns the number converted
+        """
+        if not self.executor:
+            return 0
+
+        converted = 0
+        for path, future in self.futures:
+            try:
+                future.result()
+                converted += 1
+            except Exception as exc:
+                print(f"Could not convert {path}: {exc}")
+        self.executor.shutdown()
+        self.futures = []
+        return converted
+
+
+def transcode_tree(root, fmt="jpeg", quality=QUALITY, workers=None, keep=False):
+    transcoder = Transcoder(fmt, quality, workers, keep)
+    for dirpath, _, filenames in os.walk(root):
+        for name in sorted(filenames):
+            transcoder.submit(os.path.join(dirpath, name))
+    return transcoder.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("dirname", help="Manga folder; every PNG below it is converted")
+    parser.add_argument("--format", choices=FORMATS.keys(), default="jpeg")
+    parser.add_argument("--quality", type=int, default=QUALITY)
+    parser.add_argument("--workers", type=int, default=None, help="Processes to use (default: all cores)")
+    parser.add_argument("--keep", action="store_true", help="Keep the original PNGs")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.dirname):
+        print("Directory name required")
+        sys.exit(1)
+
+    converted = transcode_tree(args.dirname, args.format, args.quality, args.workers, args.keep)
+    print(f"Converted {converted} images")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+
+# Counters and latency histograms for the scrapers, per host and per stage
+# (list_fetch, page_fetch, image_fetch, parse, render, disk_write).
+#
+# With --metrics PATH a script rewrites PATH every few seconds in the
+# Prometheus text format (point node_exporter's textfile collector at its
+# directory), and writes a JSON summary of the run next to it (PATH with a
+# .json extension) when it exits. Without it, nothing is written.
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+#--------   constants   --------
+PREFIX = "scraper_"
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)     # seconds
+EXPORT_INTERVAL = 10                            # seconds between textfile rewrites
+LOCAL = "local"                                 # host label of the stages that don't use the network
+#--------   /constants  --------
+
+HELP = {
+    "requests_total": ("counter", "HTTP requests sent, by status code ('error' if none came back)"),
+    "request_duration_seconds": ("histogram", "Time from sending a request to receiving its headers"),
+    "response_bytes_total": ("counter", "Response body bytes, as far as they are known"),
+    "stage_duration_seconds": ("histogram", "Time spent in a local stage (parse, render, disk_write)"),
+    "stage_errors_total": ("counter", "Local stage calls that raised"),
+    "written_bytes_total": ("counter", "Bytes written to disk"),
+    "queue_depth": ("gauge", "Items waiting in a pipeline queue"),
+    "host_rate": ("gauge", "Requests per second currently allowed to a host (adaptive rate limiting)"),
+    "run_seconds": ("gauge", "Time since the script started"),
+}
+
+
+class Histogram:
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for num, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[num] += 1
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket holding the q-quantile (like histogram_quantile, without interpolation)
+        """
+        if not self.count:
+            return None
+        for bound, count in zip(BUCKETS, self.buckets):
+            if count >= q * self.count:
+                return bound
+        return float("inf")
+
+
+class _Timing:
+    bytes = 0
+
+
+class Registry:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(int)        # (name, labels) -> value
+        self.histograms = defaultdict(Histogram)
+        self.gauges = {}
+        self.started = time.time()
+        self.path = None
+
+    def inc(self, name, labels, value=1):
+        with self.lock:
+            self.counters[name, labels] += value
+
+    def observe(self, name, labels, value):
+        with self.lock:
+            self.histograms[name, labels].observe(value)
+
+    def set_gauge(self, name, labels, value):
+        with self.lock:
+            self.gauges[name, labels] = value
+
+    @contextmanager
+    def timed(self, stage, host=LOCAL):
+        """
+        Time a local stage. Set .bytes on the yielded object to count bytes written.
+        """
+        timing = _Timing()
+        labels = (("host", host), ("stage", stage))
+        start = time.perf_counter()
+        try:
+            yield timing
+        except BaseException:
+            self.inc("stage_errors_total", labels)
+            raise
+        finally:
+            self.observe("stage_duration_seconds", labels, time.perf_counter() - start)
+            if timing.bytes:
+                self.inc("written_bytes_total", labels, timing.bytes)
+
+    def instrument(self, getter, stage):
+        """
+        Wrap getter (a session's get, ...) to count its requests, status codes,
+        latency and bytes under stage. Wrap it before any rate limiting, so
+        that the time spent waiting for a turn isn't counted as latency.
+        """
+        def instrumented_get(url, **kwargs):
+            host = urlparse(url).netloc
+            start = time.perf_counter()
+            try:
+                resp = getter(url, **kwargs)
+            except Exception:
+                self.inc("requests_total", (("code", "error"), ("host", host), ("stage", stage)))
+                raise
+            labels = (("host", host), ("stage", stage))
+            self.observe("request_duration_seconds", labels, time.perf_counter() - start)
+            self.inc("requests_total", (("code", str(resp.status_code)), ("host", host), ("stage", stage)))
+            size = resp.headers.get("Content-Length")
+            if size is None and not kwargs.get("stream"):
+                size = len(resp.content)
+            self.inc("response_bytes_total", labels, int(size or 0))
+            return resp
+        return instrumented_get
+
+    #-------------------------------#
+    #  Export                       #
+    #-------------------------------#
+    def render(self):
+        """
+        Everything recorded so far, in the Prometheus text exposition format
+        """
+        def fmt(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+        def number(value):
+            # repr keeps every digit of a float, :g would cut it to six
+            return str(value) if isinstance(value, int) else repr(float(value))
+
+        with self.lock:
+            self.gauges["run_seconds", ()] = time.time() - self.started
+            series = defaultdict(list)          # name -> (labels, lines of that label set)
+            for (name, labels), value in self.counters.items():
+                series[name].append((labels, [f"{PREFIX}{name}{fmt(labels)} {number(value)}"]))
+            for (name, labels), value in self.gauges.items():
+                series[name].append((labels, [f"{PREFIX}{name}{fmt(labels)} {number(value)}"]))
+            for (name, labels), hist in self.histograms.items():
+                # buckets in ascending order, then +Inf, _sum and _count
+                rows = [f"{PREFIX}{name}_bucket{fmt(labels, [('le', bound)])} {count}"
+                        for bound, count in zip(BUCKETS, hist.buckets)]
+                rows += [f"{PREFIX}{name}_bucket{fmt(labels, [('le', '+Inf')])} {hist.count}",
+                         f"{PREFIX}{name}_sum{fmt(labels)} {number(hist.sum)}",
+                         f"{PREFIX}{name}_count{fmt(labels)} {hist.count}"]
+                series[name].append((labels, rows))
+
+        lines = []
+        for name in sorted(series):
+            kind, text = HELP.get(name, ("untyped", name))
+            lines += [f"# HELP {PREFIX}{name} {text}", f"# TYPE {PREFIX}{name} {kind}"]
+            for _, rows in sorted(series[name], key=lambda item: item[0]):
+                lines += rows
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """
+        Totals per host and stage, for the JSON run summary
+        """
+        rows = defaultdict(lambda: {"requests": 0, "errors": 0, "bytes": 0})
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                label = dict(labels)
+                row = rows[label["host"], label["stage"]]
+                if name == "requests_total":
+                    row["requests"] += int(value)
+                    if label["code"] == "error" or int(label["code"]) >= 400:
+                        row["errors"] += int(value)
+                elif name == "stage_errors_total":
+                    row["errors"] += int(value)
+                elif name in ("response_bytes_total", "written_bytes_total"):
+                    row["bytes"] += int(value)
+            for (name, labels), hist in self.histograms.items():
+                label = dict(labels)
+                row = rows[label["host"], label["stage"]]
+                row["calls"] = hist.count
+                row["seconds"] = round(hist.sum, 3)
+                row["p50_le"] = hist.quantile(0.5)
+                row["p95_le"] = hist.quantile(0.95)
+
+        elapsed = time.time() - self.started
+        return {
+            "argv": sys.argv,
+            "started": self.started,
+            "seconds": round(elapsed, 3),
+            "hosts": [{"host": host, "stage": stage, **row,
+                       "bytes_per_sec": round(row["bytes"] / elapsed, 1) if elapsed else 0}
+                      for (host, stage), row in sorted(rows.items())],
+        }
+
+    def write_textfile(self, path=None):
+        path = path or self.path
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+    def write_summary(self, path=None):
+        path = path or os.path.splitext(self.path)[0] + ".json"
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def configure(self, path, interval=EXPORT_INTERVAL):
+        """
+        Start exporting to path every interval seconds, and once more (with the summary) at exit
+        """
+        if not path:
+            return
+        self.path = os.path.abspath(path)       # the manga scripts chdir
+
+        def export():
+            while True:
+                time.sleep(interval)
+                self.write_textfile()
+
+        threading.Thread(target=export, daemon=True).start()
+        atexit.register(self.write_summary)
+        atexit.register(self.write_textfile)
+
+
+# the one registry every script records into
+registry = Registry()
+timed = registry.timed
+instrument = registry.instrument
+set_gauge = registry.set_gauge
+configure = registry.configure
@@ -1,28 +1,46 @@
 #!/usr/bin/env python
 
-import requests
-import bs4
 import argparse
-import sys
 from dataclasses import dataclass
 #import cloudscraper
-import pdfkit
-import os
-import time
-import subprocess
 import datetime
+import scrapeutil
+import httpcache
+import httpsession
+import htmlparse
+import novelstore
+import novelrender
+import epubwriter
+import metrics
+import profiling
 #--------   constants   --------
 URL_MAIN = "https://novelfull.com/{novelName}"
 URL_CHAPTER  = "https://novelfull.com{chapterLink}"
 URL = "https://novelfull.com/{novelName}.html?page={pageNum}"
-POLITENESS_FACTOR = 1                         # delay between downloads, in seconds
+START_RATE = 1                                  # requests per second to a host without a rate saved by an earlier run
+MAX_RATE = 4                                    # the adaptive rate never goes above this
+WORKERS = 1                                     # concurrent chapter downloads
 
-# html5lib is needed because the HTML of novelfull is often broken
+# html5lib is needed because the HTML of novelfull is often broken;
+# pages are tried with the fast parser first and fall back to this one
 HTML_PARSER = "html5lib"                        # alt: html.parser
 
 HEADERS_TO_REPLACE = ["h3", "h4"]
+
+METADATA_HTML = """
+                <p style="page-break-before: always;">
+                    <b>Extra metadata</b>
+                    <p>Downloaded from: <a href="{url}">{name}</a></p>
+                    <p >Created on: {date} </p>
+                    <p>Created using: novelfull_dl.py </p>
+                </p>"""
 #--------   /constants  --------
 
+# per-host rate, adapted to the responses and remembered across runs;
+# shared by all the workers
+rate_limiter = scrapeutil.AdaptiveRateLimiter(START_RATE, MAX_RATE, scrapeutil.RATE_STATE_PATH)
+session = httpsession.make_session()
+
 
 @dataclass
 class Chapter:
@@ -39,8 +57,18 @@ def clean_chapter_name(chapName):
     return chapName.replace(':', '_')
 
 
+def has_chapter_bounds(soup):
+    """
+    True if the script the text starts after and the link it ends at are both inside div#chapter-content
+    """
+    div = soup.find("div", {"id": "chapter-content"})
+    script = div.find("script") if div else None
+    return script is not None and any(node.name == 'a' for node in script.next_siblings)
+
+
 def get_chapter_content(chapter_html):
-    soup = bs4.BeautifulSoup(chapter_html, HTML_PARSER)
+    soup = htmlparse.parse(chapter_html, "div", {"id": "chapter-content"}, check=has_chapter_bounds,
+                           fallback=HTML_PARSER)
     div = soup.find("div", {"id": "chapter-content"})
     node = div.find("script")
     content = []
@@ -53,8 +81,8 @@ def get_chapter_content(chapter_html):
     return content
 
 
-def download_from_url(url):
-    resp = requests.get(url)
+def download_from_url(url, ttl=httpcache.TTL_CHAPTER, stage="page_fetch"):
+    resp = httpcache.http_cache.get(url, ttl, rate_limiter.limit(metrics.instrument(session.get, stage)))
     if not resp.ok:
         return None
     
@@ -64,107 +92,115 @@ def download_from_url(url):
 def get_chapter_processed(chapter_list, chapter_idx):
         
         ch1 = chapter_list[chapter_idx]
-        contents = download_from_url(URL_CHAPTER.format(chapterLink=ch1.url))
-        soup = bs4.BeautifulSoup(contents, HTML_PARSER)
+        with profiling.stage("network", ch1.name):
+            contents = download_from_url(URL_CHAPTER.format(chapterLink=ch1.url))
+        with profiling.stage("parse", ch1.name):
+            soup = htmlparse.parse(contents, "div", {"id": "chapter-content"}, check=has_chapter_bounds,
+                                   fallback=HTML_PARSER)
 
         content = soup.find("div", {"id": "chapter-content"})
 
-        # replace h3 headings with h2 headers
-        # for proper chapter titles 
-        for header in HEADERS_TO_REPLACE:
-            hx = content.find(header)
-            if hx:
-                h2 = soup.new_tag("h2")
-                h2.string = hx.string
-                hx.replace_with(h2)
+        with profiling.stage("dom", ch1.name):
+            # replace h3 headings with h2 headers
+            # for proper chapter titles 
+            for header in HEADERS_TO_REPLACE:
+                hx = content.find(header)
+                if hx:
+                    h2 = soup.new_tag("h2")
+                    h2.string = hx.string
+                    hx.replace_with(h2)
         
 
-        ''' 
-        adjacentTags = soup.findAll("ins")
-        for tag in adjacentTags:
-            if 'data-ad-slot' in tag.attrs:
-                div = tag.findNext('div')
-                p = tag.findNext('p')
-                if p:
-                    contentString += str(p)
-                if div:
-                    contentString += str(p)
-        '''
+            ''' 
+            adjacentTags = soup.findAll("ins")
+            for tag in adjacentTags:
+                if 'data-ad-slot' in tag.attrs:
+                    div = tag.findNext('div')
+                    p = tag.findNext('p')
+                    if p:
+                        contentString += str(p)
+                    if div:
+                        contentString += str(p)
+            '''
         
-        for div in content.findAll("div", {"class": "ads"}):
-            div.decompose()
+            for div in content.findAll("div", {"class": "ads"}):
+                div.decompose()
 
-        for script in content.findAll("script"):
-            script.decompose()
+            for script in content.findAll("script"):
+                script.decompose()
         
-        return str(content) #+ contentString
-
-def make_pdf(chapter_list, novelName):
+        with profiling.stage("assemble", ch1.name):
+            return str(content) #+ contentString
 
-    #generate default toc
-    if not os.path.exists("default_toc.xsl"):
-        with open('default_toc.xsl', 'w') as outfile:
-            subprocess.call(['wkhtmltopdf', '--dump-default-toc-xsl'], stdout=outfile)
-
-    toc = {
-        'xsl-style-sheet': 'default_toc.xsl'
-    }
+def download_chapters(chapter_list, novelName, workers=WORKERS):
+    """
+    Fetch the chapters that are missing from the novel's store and return the store.
+    chapter_list must be sorted by Chapter.index.
+    """
+    fetch = lambda index: get_chapter_processed(chapter_list, index)
 
-    body = ''
-    print("Downloading chapters and generating the PDF file...")
+    # only chapters missing from the store are downloaded
+    store = novelstore.NovelStore(novelName)
+    missing = [index for index, chapter in enumerate(chapter_list) if not store.has(chapter)]
 
-    #for index in range(len(chapter_list)):
     num_processed = 0
-    print(f"Downloading  {len(chapter_list)} chapters")
-    for index in range(len(chapter_list)):
+    print(f"Downloading  {len(missing)} new chapters of {len(chapter_list)}")
+    for index, content in scrapeutil.fetch_in_order(missing, fetch, workers):
+        with profiling.stage("store", chapter_list[index].name):
+            store.add(chapter_list[index], content)
         num_processed += 1
         if num_processed % 50 == 0:
             print(f"Processed {num_processed} chapters")
+    store.save()
 
-        chapter = chapter_list[index]
-        content = get_chapter_processed(chapter_list, index)
+    return store
+
+def sections(chapter_list, store):
+    """
+    Chapter HTML for the PDF, read back from the store one chapter at a time
+    """
+    for index, chapter in enumerate(chapter_list):
+        content = store.load(chapter)
 
-        # add this chapter to the body
+        # the chapter content carries its own h2 title
         if index == 0:
-            #body += f'<h2>{chapter.name}</h2>'+ content
-            body += content
+            yield content
         else:
-            #body += f'<h2 style="page-break-before: always;">{chapter.name}</h2>'+ "".join(content)
-            body += '<hr style="page-break-before: always;"/>' + content
+            yield f'<hr {novelrender.PAGE_BREAK}/>' + content
 
-        time.sleep(POLITENESS_FACTOR)
+def make_pdf(chapter_list, store, novelName, volume_size=0, split=False, render_jobs=novelrender.RENDER_JOBS):
 
-    options = {
-            'margin-bottom': '20mm',
-            'footer-center': '[page]'
-    }
-        
-    output = """
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <meta charset="utf-8">
-            </head>
-            <body>
-            {body}
-                <p style="page-break-before: always;">
-                    <b>Extra metadata</b>
-                    <p>Downloaded from: <a href="{url}">{name}</a></p>
-                    <p >Created on: {date} </p>
-                    <p>Created using: novelfull_dl.py /p>
-                </p>
-            </body>
-            </html>""".format(body=body, 
-                            date=str(datetime.datetime.now()),
-                            name=novelName,
-                            url=URL_MAIN.format(novelName=novelName)
+    print("Generating the PDF file...")
+
+    metadata = METADATA_HTML.format(date=str(datetime.datetime.now()),
+                                    name=novelName,
+                                    url=URL_MAIN.format(novelName=novelName)
                     )      # handle unicode
 
-    #pdfkit.from_string(output, "{name}.pdf", options=options)
-    
-    pdfkit.from_string(output, f"{novelName}.pdf", toc=toc, options=options)
+    if volume_size:
+        volumes = [sections(chapter_list[start:start+volume_size], store)
+                   for start in range(0, len(chapter_list), volume_size)]
+        novelrender.render_volumes(volumes, metadata, f"{novelName}.pdf", render_jobs, merge=not split)
+    else:
+        novelrender.render_pdf(sections(chapter_list, store), metadata, f"{novelName}.pdf")
+
+def make_epub(chapter_list, store, novelName):
+    with epubwriter.EpubWriter(f"{novelName}.epub", novelName, source=URL_MAIN.format(novelName=novelName)) as book:
+        for chapter in chapter_list:
+            with profiling.stage("epub", chapter.name):
+                book.add_chapter(chapter.name, store.load(chapter))
+
+def count_pages(soup):
+    """
+    Number of chapter list pages, from the pagination of any of them
+    """
+    title_list_cont = soup.find("div", {"id": "list-chapter"})
+
+    pagination = title_list_cont.find("ul", {"class": "pagination"})
+    last = pagination.find("li", {"class": "last"})
+    return int( (last.select("li > a")[0]["data-page"]).strip() ) + 1
 
-def extract_chapters(novelName, html_page):
+def extract_chapters(novelName, html_page, workers=WORKERS):
     
     print("Obtaining initial data...")
 
@@ -179,13 +215,9 @@ def extract_chapters(novelName, html_page):
         return li
 
     chapter_list = []
-    soup = bs4.BeautifulSoup(html_page, HTML_PARSER)
+    soup = htmlparse.parse(html_page, "div", {"id": "list-chapter"}, fallback=HTML_PARSER)
 
-    title_list_cont = soup.find("div", {"id": "list-chapter"})
-
-    pagination = title_list_cont.find("ul", {"class": "pagination"})
-    last = pagination.find("li", {"class": "last"})
-    last_page = int( (last.select("li > a")[0]["data-page"]).strip() ) + 1
+    last_page = count_pages(soup)
 
     #title_list = soup.find("ul", {"class": "list-chapter"})
 
@@ -194,12 +226,15 @@ def extract_chapters(novelName, html_page):
     
     print("Gathering links...")
 
-    for pageNum in range(2, last_page+1):
-        time.sleep(POLITENESS_FACTOR)
+    def fetch_page(pageNum):
+        page_content = download_from_url(URL.format(novelName=novelName, pageNum=pageNum), httpcache.TTL_LIST,
+                                         "list_fetch")
+        page_soup = htmlparse.parse(page_content, "div", {"id": "list-chapter"}, fallback=HTML_PARSER)
+        return extract_links_and_titles(page_soup)
 
-        page_content = download_from_url(URL.format(novelName=novelName, pageNum=pageNum))
-        page_soup = bs4.BeautifulSoup(page_content, HTML_PARSER)
-        title_link_list.extend(extract_links_and_titles(page_soup))
+    # the remaining pages are fetched concurrently, but merged in page order
+    for pageNum, links in scrapeutil.fetch_in_order(range(2, last_page+1), fetch_page, workers):
+        title_link_list.extend(links)
     
     for idx, (title, link) in enumerate(title_link_list):
         chapter_list.append( Chapter(idx, title, link) )
@@ -208,19 +243,54 @@ def extract_chapters(novelName, html_page):
 
     return chapter_list
 
+def get_chapter_list(novelName, workers=WORKERS):
+    """
+    The novel's chapters, sorted by index
+    """
+    page_content = download_from_url(URL.format(novelName=novelName, pageNum=1), httpcache.TTL_LIST, "list_fetch")
+    chapter_list = extract_chapters(novelName, page_content, workers)
+    chapter_list.sort(key=lambda chap: chap.index)
+    return chapter_list
+
 def main():
-    if len(sys.argv) == 1:
-        novelName = 'my-senior-brother-is-too-steady'
+    parser = argparse.ArgumentParser()
+    parser.add_argument("novelName", nargs="?", default='my-senior-brother-is-too-steady',
+                        help="Name of the novel, as it appears in the URL")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="Number of chapters to download concurrently")
+    parser.add_argument("--rate", type=float, default=MAX_RATE,
+                        help="Max requests per second to the host; the rate adapts below it")
+    parser.add_argument("--fixed-rate", action="store_true",
+                        help="Send exactly --rate requests per second to the host, without adapting")
+    parser.add_argument("--no-cache", action="store_true", help="Bypass the shared HTTP cache")
+    parser.add_argument("--volume-size", type=int, default=0,
+                        help="Render volumes of this many chapters in parallel (0 = one document)")
+    parser.add_argument("--split", action="store_true", help="Keep the volumes as separate PDFs instead of merging them")
+    parser.add_argument("--render-jobs", type=int, default=novelrender.RENDER_JOBS,
+                        help="Number of volumes rendered at once")
+    parser.add_argument("--format", choices=["pdf", "epub"], default="pdf", help="Output format")
+    parser.add_argument("--metrics", help="Export Prometheus metrics to this file (and a JSON run summary next to it)")
+    parser.add_argument("--profile", metavar="PREFIX",
+                        help="Time every stage per chapter; write PREFIX.txt and a PREFIX.trace.json timeline")
+    parser.add_argument("--cprofile", action="store_true", help="With --profile, also run cProfile on all threads")
+    parser.add_argument("--tracemalloc", action="store_true", help="With --profile, also trace memory allocations")
+    args = parser.parse_args()
+    if (args.cprofile or args.tracemalloc) and not args.profile:
+        parser.error("--cprofile and --tracemalloc need --profile")
+
+    novelName = args.novelName
+    rate_limiter.set_rate(args.rate, adaptive=not args.fixed_rate)
+    httpcache.http_cache.enabled = not args.no_cache
+    metrics.configure(args.metrics)
+    if args.profile:
+        profiling.enable(args.profile, args.cprofile, args.tracemalloc)
+
+    chapter_list = get_chapter_list(novelName, args.workers)
+    store = download_chapters(chapter_list, novelName, args.workers)
+    if args.format == "epub":
+        make_epub(chapter_list, store, novelName)
     else:
-        novelName = sys.argv[1]
-
-    
-
-    page_content = download_from_url(URL.format(novelName=novelName, pageNum=1))
-    
-    chapter_list = extract_chapters(novelName, page_content)
-    #print(chapter_list)
-    make_pdf(chapter_list, novelName)
+        make_pdf(chapter_list, store, novelName, args.volume_size, args.split, args.render_jobs)
+    httpsession.print_stats(session)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+# PDF rendering shared by the novel downloaders.
+# The HTML document is streamed chapter by chapter into a temporary file and
+# wkhtmltopdf reads it from there, so the whole book is never held in memory
+# as one string.
+#
+# Long novels can also be split into volumes which are rendered by parallel
+# wkhtmltopdf processes and then merged (with pypdf) into one PDF with a
+# continuous table of contents and page numbers.
+import html
+import io
+import os
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import pdfkit
+
+import metrics
+import profiling
+
+#--------   constants   --------
+TOC_XSL = "default_toc.xsl"
+PDF_OPTIONS = {
+        'margin-bottom': '20mm',
+        'footer-center': '[page]'
+}
+PAGE_BREAK = 'style="page-break-before: always;"'
+
+RENDER_JOBS = os.cpu_count() or 1               # wkhtmltopdf processes run at once
+VOLUME_OPTIONS = {                              # page numbers are stamped on after merging
+        'margin-bottom': '20mm',
+}
+TOC_TITLE = "Table of Contents"
+
+HTML_HEAD = """
+            <!DOCTYPE html>
+            <html>
+            <head>
+                <meta charset="utf-8">
+            </head>
+            <body>
+"""
+HTML_TAIL = """
+            </body>
+            </html>"""
+#--------   /constants  --------
+
+
+def get_toc():
+    #generate default toc
+    if not os.path.exists(TOC_XSL):
+        with open(TOC_XSL, 'w') as outfile:
+            subprocess.call(['wkhtmltopdf', '--dump-default-toc-xsl'], stdout=outfile)
+
+    return {
+        'xsl-style-sheet': TOC_XSL
+    }
+
+
+def write_html(outfile, sections, metadata):
+    """
+    Write the document to outfile one section (chapter HTML) at a time,
+    followed by the metadata block
+    """
+    outfile.write(HTML_HEAD)
+    for section in sections:
+        outfile.write(section)
+    outfile.write(metadata)
+    outfile.write(HTML_TAIL)
+
+
+def write_temp_html(sections, metadata):
+    # wkhtmltopdf needs a path to read from, so the file has to have a name
+    with tempfile.NamedTemporaryFile("w", suffix=".html", encoding="utf-8", dir=".", delete=False) as tmp:
+        write_html(tmp, sections, metadata)
+    return tmp.name
+
+
+def render_pdf(sections, metadata, output_path):
+    """
+    Stream sections into a temporary HTML file and render it to output_path
+    """
+    with metrics.timed("render"):
+        with profiling.stage("html_assembly", output_path):
+            path = write_temp_html(sections, metadata)
+        try:
+            with profiling.stage("wkhtmltopdf", output_path):
+                pdfkit.from_file(path, output_path, toc=get_toc(), options=PDF_OPTIONS)
+        finally:
+            os.remove(path)
+
+
+def render_volume(html_path, output_path, toc, options):
+    with metrics.timed("render"), profiling.stage("wkhtmltopdf", os.path.basename(output_path)):
+        pdfkit.from_file(html_path, output_path, toc=toc, options=options)
+
+
+def render_volumes(volumes, metadata, output_path, jobs=RENDER_JOBS, merge=True):
+    """
+    Render each volume (an iterable of sections) in its own wkhtmltopdf process,
+    up to `jobs` at a time. With merge, the volumes are joined into output_path;
+    otherwise they are kept as <output>_vol<N>.pdf, each with its own TOC.
+    """
+    if merge:
+        try:
+            import pypdf
+        except ImportError:
+            print("Error: merging volumes needs pypdf (pip install pypdf). Aborting...")
+            sys.exit(1)
+
+    base, ext = os.path.splitext(output_path)
+    volume_paths = [f"{base}_vol{num+1}{ext}" for num in range(len(volumes))]
+    toc = None if merge else get_toc()
+    options = VOLUME_OPTIONS if merge else PDF_OPTIONS
+
+    # each volume's HTML is written while the earlier ones are already rendering
+    html_paths = []
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = []
+            for num, sections in enumerate(volumes):
+                with profiling.stage("html_assembly", os.path.basename(volume_paths[num])):
+                    path = write_temp_html(sections, metadata if num == len(volumes) - 1 else "")
+                html_paths.append(path)
+                futures.append(executor.submit(render_volume, path, volume_paths[num], toc, options))
+                print(f"Rendering volume {num+1}...")
+            for future in futures:
+                future.result()
+    finally:
+        for path in html_paths:
+            os.remove(path)
+
+    if merge:
+        try:
+            with profiling.stage("merge", os.path.basename(output_path)):
+                merge_volumes(volume_paths, output_path)
+        finally:
+            for path in volume_paths:
+                os.remove(path)
+
+
+def _render_to_reader(document, options):
+    import pypdf
+    return pypdf.PdfReader(io.BytesIO(pdfkit.from_string(document, False, options=options)))
+
+
+def _toc_html(entries, page_offset):
+    rows = "".join(f'<tr><td>{html.escape(title)}</td><td style="text-align: right;">{page + page_offset + 1}</td></tr>'
+                   for title, page in entries)
+    return f'{HTML_HEAD}<h1>{TOC_TITLE}</h1><table style="width: 100%;">{rows}</table>{HTML_TAIL}'
+
+
+def merge_volumes(volume_paths, output_path):
+    """
+    Join the rendered volumes into output_path behind a printed TOC.
+    The chapter bookmarks of every volume are kept, and page numbers
+    continue across volumes.
+    """
+    import pypdf
+
+    # chapter titles (top level of each volume's outline) and their page in the body
+    readers = [pypdf.PdfReader(path) for path in volume_paths]
+    entries = []
+    num_body_pages = 0
+    for reader in readers:
+        for item in reader.outline:
+            if isinstance(item, list):                  # sub-headings of the previous chapter
+                continue
+            entries.append((item.title, num_body_pages + reader.get_destination_page_number(item)))
+        num_body_pages += len(reader.pages)
+
+    # the TOC's own length shifts the body's page numbers; settle it first
+    toc_pages = 1
+    toc_reader = _render_to_reader(_toc_html(entries, toc_pages), PDF_OPTIONS)
+    while len(toc_reader.pages) != toc_pages:
+        toc_pages = len(toc_reader.pages)
+        toc_reader = _render_to_reader(_toc_html(entries, toc_pages), PDF_OPTIONS)
+
+    # blank, transparent pages carrying nothing but the footer page number
+    blank_pages = "&nbsp;" + f"<p {PAGE_BREAK}>&nbsp;</p>" * (num_body_pages - 1)
+    stamp_options = dict(PDF_OPTIONS, **{'page-offset': toc_pages, 'no-background': None})
+    stamps = _render_to_reader(f"{HTML_HEAD}{blank_pages}{HTML_TAIL}", stamp_options)
+
+    writer = pypdf.PdfWriter()
+    writer.append(toc_reader, import_outline=False)
+    for reader in readers:
+        writer.append(reader)
+    for page_num in range(min(num_body_pages, len(stamps.pages))):
+        writer.pages[toc_pages + page_num].merge_page(stamps.pages[page_num])
+
+    with open(output_path, "wb") as f:
+        writer.write(f)
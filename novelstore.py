@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+# Per-novel store of already downloaded chapters, so that reruns only fetch
+# chapters that are new since the last run.
+#
+# Layout:
+#   <dirname>/manifest.json         {chapter url: {"name": ..., "sha256": ...}}
+#   <dirname>/chapters/<sha256>     processed chapter HTML
+import hashlib
+import json
+import os
+
+import metrics
+
+#--------   constants   --------
+STORE_DIR_FORMAT = "{name}_chapters"
+MANIFEST_NAME = "manifest.json"
+SAVE_EVERY = 20                                 # write the manifest after this many new chapters
+#--------   /constants  --------
+
+
+class NovelStore:
+
+    def __init__(self, name, dirname=None):
+        self.dirname = dirname or STORE_DIR_FORMAT.format(name=name)
+        self.chapter_dir = os.path.join(self.dirname, "chapters")
+        self.manifest_path = os.path.join(self.dirname, MANIFEST_NAME)
+        self.unsaved = 0
+
+        os.makedirs(self.chapter_dir, exist_ok=True)
+        self.manifest = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, encoding="utf-8") as f:
+                self.manifest = json.load(f)
+
+    def _path(self, digest):
+        return os.path.join(self.chapter_dir, digest)
+
+    def has(self, chapter):
+        entry = self.manifest.get(chapter.url)
+        return entry is not None and os.path.exists(self._path(entry["sha256"]))
+
+    def missing(self, chapter_list):
+        """
+        Chapters of chapter_list that have not been stored yet
+        """
+        return [chapter for chapter in chapter_list if not self.has(chapter)]
+
+    def add(self, chapter, content):
+        data = content.encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._path(digest)
+        if not os.path.exists(path):
+            with metrics.timed("disk_write") as timing:
+                with open(path + ".tmp", "wb") as f:
+                    f.write(data)
+                os.replace(path + ".tmp", path)
+                timing.bytes = len(data)
+
+        self.manifest[chapter.url] = {"name": chapter.name, "sha256": digest}
+        self.unsaved += 1
+        if self.unsaved >= SAVE_EVERY:
+            self.save()
+
+    def load(self, chapter):
+        entry = self.manifest[chapter.url]
+        with open(self._path(entry["sha256"]), encoding="utf-8") as f:
+            return f.read()
+
+    def save(self):
+        tmp = self.manifest_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(tmp, self.manifest_path)
+        self.unsaved = 0
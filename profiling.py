@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+# Stage profiler for the novel downloaders (--profile PREFIX).
+# The pipeline marks its stages (network, parse, dom, assemble, store,
+# html_assembly, wkhtmltopdf, ...) with
+#     with profiling.stage("parse", chapter.name):
+# and with profiling on, every stage is timed per chapter; with --tracemalloc
+# the memory each stage leaves allocated is measured too. At exit it writes
+#   PREFIX.txt          stages sorted by total time, the slowest chapters of
+#                       each, and the cProfile / tracemalloc top lists if on
+#   PREFIX.trace.json   Chrome trace-event timeline, one row per thread
+#                       (open it in chrome://tracing or ui.perfetto.dev)
+#   PREFIX.prof         raw cProfile stats (with --cprofile), for pstats/snakeviz
+# Without --profile, stage() does nothing.
+import atexit
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+
+#--------   constants   --------
+SLOWEST = 5                                     # slowest chapters listed per stage
+TOP_FUNCTIONS = 30                              # cProfile entries in the report
+TOP_ALLOCATIONS = 15                            # tracemalloc entries in the report
+#--------   /constants  --------
+
+
+class StageProfiler:
+
+    def __init__(self):
+        self.enabled = False
+        self.memory = False
+        self.prefix = None
+        self.lock = threading.Lock()
+        self.events = []                        # (stage, label, thread id, start, seconds, memory delta)
+        self.threads = {}                       # thread id -> name
+        self.profiles = []                      # one cProfile.Profile per thread
+        self.origin = time.perf_counter()
+        self.started = time.time()
+
+    @contextmanager
+    def stage(self, name, label=None):
+        """
+        Time the body as stage name; label says what it worked on (chapter, volume)
+        """
+        if not self.enabled:
+            yield
+            return
+        memory = tracemalloc.get_traced_memory()[0] if self.memory else 0
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            delta = tracemalloc.get_traced_memory()[0] - memory if self.memory else 0
+            thread = threading.current_thread()
+            with self.lock:
+                self.threads[thread.ident] = thread.name
+                self.events.append((name, label, thread.ident, start - self.origin, seconds, delta))
+
+    def _profile_thread(self, *args):
+        # installed with threading.setprofile: runs once in every new thread
+        # (worker pools included) and hands the thread over to its own cProfile
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        profile.enable()
+
+    def enable(self, prefix, cprofile=False, memory=False):
+        """
+        Start profiling; the report is written to prefix.* at exit
+        """
+        self.prefix = os.path.abspath(prefix)
+        self.enabled = True
+        self.memory = memory
+        self.origin = time.perf_counter()
+        self.started = time.time()
+        if memory:
+            tracemalloc.start()
+        if cprofile:
+            self._profile_thread()
+            threading.setprofile(self._profile_thread)
+        atexit.register(self.write)
+
+    #-------------------------------#
+    #  Report                       #
+    #-------------------------------#
+    def stage_table(self, wall):
+        totals = defaultdict(lambda: [0, 0.0, 0.0, 0])  # stage -> calls, total, max, memory
+        slowest = defaultdict(list)
+        for name, label, _, _, seconds, delta in self.events:
+            row = totals[name]
+            row[0] += 1
+            row[1] += seconds
+            row[2] = max(row[2], seconds)
+            row[3] += delta
+            slowest[name].append((seconds, label))
+
+        lines = [f"{'stage':<16}{'calls':>7}{'total s':>10}{'mean ms':>10}{'max ms':>10}{'% wall':>8}"
+                 + (f"{'mem KB':>10}" if self.memory else "")]
+        order = sorted(totals.items(), key=lambda item: item[1][1], reverse=True)
+        for name, (calls, total, longest, delta) in order:
+            lines.append(f"{name:<16}{calls:>7}{total:>10.3f}{total / calls * 1000:>10.1f}{longest * 1000:>10.1f}"
+                         f"{total / wall * 100:>8.1f}" + (f"{delta / 1024:>10.0f}" if self.memory else ""))
+        lines.append("(stages run on several threads at once can add up to more than 100% of the wall time)")
+
+        lines += ["", f"Slowest {SLOWEST} per stage:"]
+        for name, _ in order:
+            worst = sorted(slowest[name], key=lambda item: item[0], reverse=True)[:SLOWEST]
+            lines.append(f"  {name}: " + ", ".join(f"{label or '-'} ({seconds * 1000:.0f} ms)"
+                                                   for seconds, label in worst))
+        return lines
+
+    def cprofile_lines(self):
+        threading.setprofile(None)
+        for profile in self.profiles:
+            profile.disable()
+        stats = pstats.Stats(*self.profiles)
+        stats.dump_stats(self.prefix + ".prof")
+        out = io.StringIO()
+        stats.stream = out
+        stats.sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+        return ["", f"cProfile, all threads, top {TOP_FUNCTIONS} by cumulative time:", out.getvalue()]
+
+    def memory_lines(self):
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        lines = ["", f"tracemalloc: {current / 1024**2:.1f} MB still allocated, {peak / 1024**2:.1f} MB peak",
+                 f"Top {TOP_ALLOCATIONS} allocation sites still holding memory:"]
+        lines += [f"  {stat}" for stat in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]]
+        return lines
+
+    def trace_events(self):
+        pid = os.getpid()
+        events = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+                  for tid, name in self.threads.items()]
+        for name, label, tid, start, seconds, delta in self.events:
+            args = {"label": label}
+            if self.memory:
+                args["memory_kb"] = round(delta / 1024, 1)
+            events.append({"name": name, "cat": "stage", "ph": "X", "pid": pid, "tid": tid,
+                           "ts": round(start * 1e6), "dur": round(seconds * 1e6), "args": args})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write(self):
+        self.enabled = False
+        wall = time.perf_counter() - self.origin
+        lines = [f"Profile of {' '.join(sys.argv)}",
+                 f"Started {time.ctime(self.started)}, {wall:.2f} s wall", ""]
+        lines += self.stage_table(wall)
+        if self.profiles:
+            lines += self.cprofile_lines()
+        if self.memory:
+            lines += self.memory_lines()
+
+        with open(self.prefix + ".txt", "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        with open(self.prefix + ".trace.json", "w") as f:
+            json.dump(self.trace_events(), f)
+        print(f"Profile written to {self.prefix}.txt and {self.prefix}.trace.json")
+
+
+# the one profiler the novel pipeline reports to
+profiler = StageProfiler()
+stage = profiler.stage
+enable = profiler.enable
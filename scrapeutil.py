@@ -0,0 +1,399 @@
+#!/usr/bin/env python
+
+# Helpers shared by the novel and manga scrapers
+import atexit
+import email.utils
+import json
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import metrics
+
+#--------   constants   --------
+DEFAULT_WORKERS = 1
+PREFETCH_FACTOR = 2                             # jobs queued per worker ahead of the consumer
+PIPELINE_QUEUE_SIZE = 4                         # items waiting between two pipeline stages
+PIPELINE_POLL = 0.1                             # seconds a blocked pipeline thread waits before checking for a stop
+
+# AdaptiveRateLimiter
+RATE_STATE_PATH = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+                               "useful_scripts", "rates.json")
+MIN_RATE = 0.05                                 # requests per second; never slower than one per 20 s
+INCREASE = 0.2                                  # requests per second gained per second of healthy responses
+DECREASE = 0.5                                  # rate multiplier on a throttling signal
+DECREASE_HOLD = 2                               # seconds after a decrease in which further signals are ignored
+LATENCY_FACTOR = 2                              # slower than this times the host's average counts as unhealthy
+LATENCY_SMOOTHING = 0.2                         # weight of the newest response in the average latency
+THROTTLE_STATUSES = (429, 503)
+SAVED_HOSTS = 200                               # hosts kept in the state file, most recently used first
+#--------   /constants  --------
+_END = object()
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket; refills `rate` tokens per second, up to `burst`
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def set_rate(self, rate):
+        with self.lock:
+            self._refill()
+            self.rate = rate
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def pause(self, seconds):
+        """
+        Hand out no token for the next `seconds`
+        """
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    def acquire(self):
+        """
+        Block until a token is available, then take it
+        """
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+
+class HostRateLimiter:
+    """
+    One token bucket per host, so that different sites don't throttle each other
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = rate
+            for bucket in self.buckets.values():
+                bucket.set_rate(rate)
+
+    def bucket(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.rate, self.burst)
+            return self.buckets[host]
+
+    def wait(self, url):
+        self.bucket(url).acquire()
+
+    def limit(self, getter):
+        """
+        Wrap getter (e.g. requests.get) so that every call waits for its host's turn
+        """
+        def limited_get(url, **kwargs):
+            self.wait(url)
+            return getter(url, **kwargs)
+        return limited_get
+
+
+def retry_after_seconds(value):
+    """
+    Seconds to wait from a Retry-After header (delay in seconds, or an HTTP date); None if absent
+    """
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return int(value)
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveRateLimiter(HostRateLimiter):
+    """
+    HostRateLimiter whose per-host rate follows the responses (AIMD). Healthy
+    responses raise a host's rate additively, by INCREASE requests/sec per
+    second, up to max_rate. A 429/503 (including ones the session already
+    retried), a Retry-After or a connection error multiplies it by DECREASE,
+    down to MIN_RATE, and a Retry-After also holds the host off for that
+    long. A response much slower than the host's average, or another 5xx,
+    keeps the rate where it is. With state_path, every host starts at the
+    rate it ended the last run with.
+    """
+
+    def __init__(self, rate, max_rate=None, state_path=None, burst=1):
+        super().__init__(rate, burst)
+        self.start_rate = rate
+        self.max_rate = max(max_rate or rate, rate)
+        self.adaptive = True
+        self.latency = {}                       # host -> running average, seconds
+        self.last_decrease = {}
+        self.state_path = state_path
+        self.saved = {}
+        if state_path:
+            self.saved = self.load_state()
+            atexit.register(self.save_state)
+
+    def set_rate(self, rate, adaptive=True):
+        """
+        Cap every host at rate; without adaptive, run every host at exactly rate
+        """
+        with self.lock:
+            self.max_rate = rate
+            self.adaptive = adaptive
+            buckets = list(self.buckets.values())
+        for bucket in buckets:
+            bucket.set_rate(min(bucket.rate, rate) if adaptive else rate)
+
+    def bucket(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.buckets:
+                rate = self.max_rate
+                if self.adaptive:
+                    rate = self.saved.get(host, {}).get("rate", self.start_rate)
+                    rate = min(max(rate, MIN_RATE), self.max_rate)
+                self.buckets[host] = TokenBucket(rate, self.burst)
+            return self.buckets[host]
+
+    def feedback(self, url, status=None, latency=None, retry_after=None, error=False):
+        """
+        Adjust the host's rate after a request: status code, seconds to the
+        response, Retry-After in seconds, or error for a failed connection
+        """
+        if not self.adaptive:
+            return
+        host = urlparse(url).netloc
+        bucket = self.bucket(url)
+        now = time.monotonic()
+        with self.lock:
+            rate = bucket.rate
+            average = self.latency.get(host)
+            if error or status in THROTTLE_STATUSES or retry_after is not None:
+                # the responses to requests sent before the decrease say the same thing again
+                if now - self.last_decrease.get(host, -DECREASE_HOLD) >= DECREASE_HOLD:
+                    rate = max(rate * DECREASE, MIN_RATE)
+                    self.last_decrease[host] = now
+            else:
+                slow = average is not None and latency is not None and latency > LATENCY_FACTOR * average
+                if not slow and (status is None or status < 500):
+                    # a response comes every 1/rate seconds, so rate grows by INCREASE per second
+                    # (by INCREASE per response below one request a second)
+                    rate = min(rate + INCREASE / max(rate, 1), self.max_rate)
+                if latency is not None:
+                    self.latency[host] = latency if average is None else average + LATENCY_SMOOTHING * (latency - average)
+            # under the lock, so that two responses of one host can't apply their rates out of order
+            bucket.set_rate(rate)
+            if retry_after:
+                bucket.pause(retry_after)
+            metrics.set_gauge("host_rate", (("host", host),), rate)
+
+    def limit(self, getter):
+        """
+        Wrap getter so that every call waits for its host's turn, and its response adjusts the host's rate
+        """
+        def limited_get(url, **kwargs):
+            self.wait(url)
+            start = time.perf_counter()
+            try:
+                resp = getter(url, **kwargs)
+            except OSError:                     # requests' exceptions are OSErrors
+                self.feedback(url, error=True)
+                raise
+            status = resp.status_code
+            # 429/503s that the session's retries already waited out
+            retries = getattr(getattr(resp, "raw", None), "retries", None)
+            if retries is not None and any(attempt.status in THROTTLE_STATUSES for attempt in retries.history):
+                status = THROTTLE_STATUSES[0]
+            retry_after = retry_after_seconds(resp.headers.get("Retry-After")) if status in THROTTLE_STATUSES else None
+            self.feedback(url, status, time.perf_counter() - start, retry_after)
+            return resp
+        return limited_get
+
+    def load_state(self):
+        try:
+            with open(self.state_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_state(self):
+        """
+        Merge the current rates of the hosts used in this run into the state file
+        """
+        if not self.adaptive or not self.buckets:
+            return
+        state = self.load_state()               # other scripts may have saved since we loaded it
+        with self.lock:
+            for host, bucket in self.buckets.items():
+                state[host] = {"rate": round(bucket.rate, 3), "updated": time.time()}
+        recent = sorted(state.items(), key=lambda item: item[1].get("updated", 0), reverse=True)[:SAVED_HOSTS]
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        tmp = f"{self.state_path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(dict(recent), f, indent=1)
+        os.replace(tmp, self.state_path)
+
+
+class HostConcurrencyLimiter:
+    """
+    Caps the number of requests in flight to each host
+    """
+
+    def __init__(self, max_in_flight):
+        self.max_in_flight = max_in_flight
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    def semaphore(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(self.max_in_flight)
+            return self.semaphores[host]
+
+    def limit(self, getter):
+        """
+        Wrap getter so that at most max_in_flight calls per host run at once
+        """
+        def limited_get(url, **kwargs):
+            with self.semaphore(url):
+                return getter(url, **kwargs)
+        return limited_get
+
+
+def fetch_in_order(items, fetch, workers=DEFAULT_WORKERS):
+    """
+    Run fetch(item) for every item on a thread pool and yield (item, result)
+    in the original order of items, however the jobs finish.
+    Only a bounded window of jobs is in flight, so results don't pile up.
+    """
+    items = iter(items)
+    window = deque()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for item in items:
+            window.append((item, executor.submit(fetch, item)))
+            if len(window) >= workers * PREFETCH_FACTOR:
+                break
+
+        while window:
+            item, future = window.popleft()
+            result = future.result()
+            nxt = next(items, _END)
+            if nxt is not _END:
+                window.append((nxt, executor.submit(fetch, nxt)))
+            yield item, result
+
+
+class _StageError:
+    def __init__(self, exc):
+        self.exc = exc
+
+
+def run_pipeline(items, stages, queue_size=PIPELINE_QUEUE_SIZE):
+    """
+    Pass every item through a chain of stages, given as (function, workers)
+    pairs. Each stage runs on its own threads and hands its results to the
+    next one through a bounded queue, so a slow stage holds back the earlier
+    ones instead of piling up work. A stage that returns None drops the item.
+    Yields the results of the last stage as they complete (in no particular order).
+    The queue in front of each stage is reported as the queue_depth metric.
+    When a stage raises or the consumer stops early, the threads are stopped.
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages] + [queue.Queue()]
+    stop = threading.Event()
+
+    def put(box, item):
+        # False once the pipeline was stopped, so a full queue can't block forever
+        while not stop.is_set():
+            try:
+                box.put(item, timeout=PIPELINE_POLL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(box):
+        while not stop.is_set():
+            try:
+                return box.get(timeout=PIPELINE_POLL)
+            except queue.Empty:
+                pass
+        return _END
+
+    def feed():
+        for item in items:
+            if not put(queues[0], item):
+                return
+        for _ in range(stages[0][1]):
+            put(queues[0], _END)
+
+    def work(num, function, live):
+        inbox, outbox = queues[num], queues[num+1]
+        labels = (("stage", getattr(function, "func", function).__name__),)     # functools.partial, or a function
+        while True:
+            item = get(inbox)
+            metrics.set_gauge("queue_depth", labels, inbox.qsize())
+            if item is _END:
+                break
+            try:
+                result = function(item)
+            except Exception as exc:
+                queues[-1].put(_StageError(exc))
+                continue
+            if result is not None and not put(outbox, result):
+                break
+
+        # the last worker of a stage to finish shuts down the next stage
+        with live[1]:
+            live[0] -= 1
+            if live[0] == 0:
+                next_workers = stages[num+1][1] if num + 1 < len(stages) else 1
+                for _ in range(next_workers):
+                    put(queues[num+1], _END)
+
+    threading.Thread(target=feed, daemon=True).start()
+    for num, (function, workers) in enumerate(stages):
+        live = [workers, threading.Lock()]
+        for _ in range(workers):
+            threading.Thread(target=work, args=(num, function, live), daemon=True).start()
+
+    try:
+        while True:
+            result = queues[-1].get()
+            if result is _END:
+                return
+            if isinstance(result, _StageError):
+                raise result.exc
+            yield result
+    finally:
+        # wake the threads still blocked on a queue, and let go of the items in flight
+        stop.set()
+        for box in queues:
+            while True:
+                try:
+                    box.get_nowait()
+                except queue.Empty:
+                    break
@@ -0,0 +1,17 @@
+import os
+import sys
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import epubwriter
+
+
+def test_to_xhtml_is_well_formed_without_scripts():
+    fragment = ('<p>one<br>two</p><script>if(a<b){document.write("<p>")}</script>'
+                '<style>p > b {}</style><noscript><img src="x"></noscript><p>a &amp; b</p>')
+    xhtml = epubwriter.to_xhtml(fragment)
+
+    root = ET.fromstring(f"<body>{xhtml}</body>")
+    assert [el.tag for el in root] == ["p", "p"]
+    assert "if(a" not in xhtml
+    assert root[1].text == "a & b"
@@ -0,0 +1,44 @@
+import os
+import sys
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import httpcache
+
+
+def response(body, content_type="text/html; charset=utf-8"):
+    resp = requests.Response()
+    resp.status_code = 200
+    resp._content = body
+    resp.headers["Content-Type"] = content_type
+    return resp
+
+
+def blob_files(directory):
+    return [name for _, _, names in os.walk(os.path.join(directory, "blobs")) for name in names]
+
+
+def test_refetched_page_does_not_leave_its_old_body_behind(tmp_path):
+    cache = httpcache.HTTPCache(str(tmp_path), max_bytes=3000)
+    for num in range(6):
+        cache.get("https://example.com/list", 0, lambda url, **kwargs: response(b"%d" % num * 500))
+    cache.get("https://example.com/chapter", 0, lambda url, **kwargs: response(b"c" * 1000))
+
+    urls = [row[0] for row in cache.db.execute("SELECT url FROM entries")]
+    assert sorted(urls) == ["https://example.com/chapter", "https://example.com/list"]
+    assert len(blob_files(str(tmp_path))) == 2
+    assert cache.db.execute("SELECT COUNT(*) FROM blobs").fetchone()[0] == 2
+
+
+def test_evict_sweeps_unreferenced_blobs(tmp_path):
+    cache = httpcache.HTTPCache(str(tmp_path), max_bytes=1500)
+    cache.get("https://example.com/a", 0, lambda url, **kwargs: response(b"a" * 1000))
+    # an orphan, as left behind by an older version of the cache
+    with cache.lock:
+        cache.db.execute("DELETE FROM entries")
+        cache.db.commit()
+    cache.get("https://example.com/b", 0, lambda url, **kwargs: response(b"b" * 1000))
+
+    assert [row[0] for row in cache.db.execute("SELECT url FROM entries")] == ["https://example.com/b"]
+    assert len(blob_files(str(tmp_path))) == 1
@@ -0,0 +1,31 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "manga_scrapers"))
+import mangadex_index
+
+
+def metadata(chapters):
+    return json.dumps({
+        "manga": {"title": "Test"},
+        "chapter": {str(100 + num): {"lang_name": "English", "volume": "1", "chapter": str(num), "title": "",
+                                     "timestamp": num}
+                    for num in chapters},
+    })
+
+
+def chapter_numbers(rows):
+    return [int(chapter_id) - 100 for _, chapter_id in rows]
+
+
+def test_chapters_since_counts_serials_over_all_chapters(tmp_path):
+    index = mangadex_index.MangaIndex(str(tmp_path / "index.sqlite"))
+    index.refresh(1, metadata(range(1, 11)))
+    since = index.refresh(1, metadata(range(1, 14)))
+
+    assert chapter_numbers(index.chapters(1, "English", 11, 12, since)) == [11, 12]
+    assert chapter_numbers(index.chapters(1, "English", 5, None, since)) == [11, 12, 13]
+    assert chapter_numbers(index.chapters(1, "English", 1, 10, since)) == []
+    assert chapter_numbers(index.chapters(1, "English", 9, 11)) == [9, 10, 11]
+    index.close()
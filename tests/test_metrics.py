@@ -0,0 +1,26 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import metrics
+
+
+def test_histogram_lines_follow_bucket_order():
+    registry = metrics.Registry()
+    labels = (("host", "example.com"), ("stage", "page_fetch"))
+    registry.observe("request_duration_seconds", labels, 0.123456789)
+    registry.observe("request_duration_seconds", labels, 45)
+
+    lines = [line for line in registry.render().splitlines() if "request_duration_seconds" in line
+             and not line.startswith("#")]
+    bounds = [line.split('le="')[1].split('"')[0] for line in lines if "_bucket" in line]
+    assert bounds == [str(bound) for bound in metrics.BUCKETS] + ["+Inf"]
+    assert "_sum{" in lines[-2] and "_count{" in lines[-1]
+    assert lines[-2].split()[-1] == repr(0.123456789 + 45)
+    assert lines[-1].split()[-1] == "2"
+
+
+def test_counters_render_as_integers():
+    registry = metrics.Registry()
+    registry.inc("response_bytes_total", (("host", "example.com"), ("stage", "page_fetch")), 1234567)
+    assert 'scraper_response_bytes_total{host="example.com",stage="page_fetch"} 1234567\n' in registry.render()
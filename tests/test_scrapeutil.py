@@ -0,0 +1,42 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import scrapeutil
+
+
+def slow(item):
+    time.sleep(0.01)
+    return item
+
+
+def fail_on_five(item):
+    if item == 5:
+        raise ValueError(item)
+    return item
+
+
+def wait_for_threads(count, timeout=2):
+    deadline = time.time() + timeout
+    while threading.active_count() > count and time.time() < deadline:
+        time.sleep(0.05)
+    return threading.active_count()
+
+
+def test_stage_error_stops_the_threads():
+    before = threading.active_count()
+    with pytest.raises(ValueError):
+        list(scrapeutil.run_pipeline(range(1000), [(slow, 2), (fail_on_five, 2), (slow, 1)]))
+    assert wait_for_threads(before) == before
+
+
+def test_closing_the_consumer_stops_the_threads():
+    before = threading.active_count()
+    results = scrapeutil.run_pipeline(range(1000), [(slow, 3), (slow, 2)])
+    next(results)
+    results.close()
+    assert wait_for_threads(before) == before
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+# Watches a list of titles for new chapters and downloads them as they appear.
+#
+# The watchlist has the same format as batch_dl.py's jobs file. Each title
+# is polled by fetching its chapter-list page through the shared HTTP cache
+# with ttl 0, which turns the poll into a conditional request (If-None-Match /
+# If-Modified-Since): an unchanged page costs a 304 and is recognised by its
+# hash without being parsed. Only when the page changed is the chapter list
+# parsed, and the chapters that weren't there at the last poll are downloaded
+# through batch_dl's site adapters. The first poll of a title only records
+# its chapters.
+#
+# Every title has its own poll interval: halved when a poll finds new
+# chapters, grown when it doesn't, doubled on errors, and always jittered so
+# that titles don't end up polled in lockstep.
+#
+#   python watch_dl.py watchlist.txt                 run until interrupted
+#   python watch_dl.py watchlist.txt --once          poll the titles that are due, then exit (cron)
+import argparse
+import hashlib
+import heapq
+import json
+import os
+import random
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import batch_dl
+import httpcache
+import metrics
+
+#--------   constants   --------
+MIN_INTERVAL = 15 * 60                          # seconds between polls of a title
+MAX_INTERVAL = 24 * 60 * 60
+START_INTERVAL = 60 * 60
+GROWTH = 1.5                                    # interval *= GROWTH after a poll without news
+JITTER = 0.2                                    # +-20% on every interval
+STATE_SUFFIX = ".state.json"
+#--------   /constants  --------
+
+
+def title_id(job):
+    return f"{job.site} {job.title}"
+
+
+class WatchState:
+    """
+    Per title: chapter keys seen so far, hash of the last list page, poll
+    interval and next poll time. Saved atomically after every poll.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.titles = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.titles = json.load(f)
+
+    def get(self, job):
+        with self.lock:
+            return self.titles.setdefault(title_id(job), {
+                "known": [], "digest": None, "interval": START_INTERVAL, "next_poll": 0, "last_change": None,
+            })
+
+    def save(self):
+        with self.lock:
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self.titles, f, indent=1)
+            os.replace(tmp, self.path)
+
+
+def next_interval(interval, changed, failed=False, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL):
+    if failed:
+        interval *= 2
+    elif changed:
+        interval /= 2
+    else:
+        interval *= GROWTH
+    return min(max(interval, min_interval), max_interval)
+
+
+def poll(job, adapter, entry, scheduler):
+    """
+    Check one title and download its new chapters. Returns the number of new chapters.
+    """
+    url, getter = adapter.list_request(job)
+    resp = httpcache.http_cache.get(url, 0, getter)
+    if not resp.ok:
+        raise RuntimeError(f"status {resp.status_code} for {url}")
+
+    digest = hashlib.sha256(resp.content).hexdigest()
+    if digest == entry["digest"]:
+        return 0
+
+    # the list page was just stored in the cache, so parsing it costs no request
+    chapters = adapter.chapter_list(job)
+    known = set(entry["known"])
+    new = [chapter for chapter in chapters if adapter.key(chapter) not in known]
+    first_poll = entry["digest"] is None
+    if new and not first_poll:
+        print(f"[{title_id(job)}] {len(new)} new chapters")
+        adapter.download_new(job, new, scheduler)
+
+    entry["known"] = sorted(known | {adapter.key(chapter) for chapter in chapters})
+    entry["digest"] = digest
+    return 0 if first_poll else len(new)
+
+
+def watch(jobs, state, budgets, titles=batch_dl.TITLES, once=False,
+          min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL):
+    scheduler = batch_dl.SiteScheduler(budgets)
+    adapters = {}
+    for site in {job.site for job in jobs}:
+        try:
+            adapters[site] = batch_dl.ADAPTERS[site]()
+        except ImportError as exc:
+            print(f"Not watching {site} titles: {exc}")
+
+    # (next poll time, position in jobs)
+    due = [(state.get(job)["next_poll"], num) for num, job in enumerate(jobs) if job.site in adapters]
+    heapq.heapify(due)
+    lock = threading.Condition()
+    busy = 0
+
+    def run(num):
+        nonlocal busy
+        job = jobs[num]
+        entry = state.get(job)
+        try:
+            found = poll(job, adapters[job.site], entry, scheduler)
+            entry["interval"] = next_interval(entry["interval"], found > 0, False, min_interval, max_interval)
+            if found:
+                entry["last_change"] = time.time()
+        except Exception:
+            print(f"[{title_id(job)}] poll failed:")
+            traceback.print_exc()
+            entry["interval"] = next_interval(entry["interval"], False, True, min_interval, max_interval)
+
+        entry["next_poll"] = time.time() + entry["interval"] * random.uniform(1 - JITTER, 1 + JITTER)
+        state.save()
+        with lock:
+            busy -= 1
+            if not once:
+                heapq.heappush(due, (entry["next_poll"], num))
+            lock.notify()
+
+    with ThreadPoolExecutor(max_workers=titles) as executor:
+        with lock:
+            while due or busy:
+                if not due or busy >= titles:
+                    lock.wait()
+                    continue
+                wait = due[0][0] - time.time()
+                if wait > 0:
+                    if once:
+                        heapq.heappop(due)      # not due yet; left for the next run
+                        continue
+                    lock.wait(wait)
+                    continue
+                _, num = heapq.heappop(due)
+                busy += 1
+                executor.submit(run, num)
+    scheduler.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("watchlist", help="Titles to watch, in batch_dl.py's jobs file format")
+    parser.add_argument("--state", help=f"Where to keep the poll state (default: <watchlist>{STATE_SUFFIX})")
+    parser.add_argument("--once", action="store_true", help="Poll the titles that are due once, then exit")
+    parser.add_argument("--min-interval", type=float, default=MIN_INTERVAL, help="Shortest poll interval (seconds)")
+    parser.add_argument("--max-interval", type=float, default=MAX_INTERVAL, help="Longest poll interval (seconds)")
+    parser.add_argument("--budget", action="append", default=[], metavar="SITE=N",
+                        help="Download tasks that may run at once for a site")
+    parser.add_argument("--titles", type=int, default=batch_dl.TITLES, help="Titles polled or downloaded at once")
+    parser.add_argument("--metrics", help="Export Prometheus metrics to this file (and a JSON run summary next to it)")
+    args = parser.parse_args()
+
+    metrics.configure(args.metrics)
+    budgets = dict(batch_dl.SITE_BUDGETS)
+    for budget in args.budget:
+        site, _, num = budget.partition("=")
+        budgets[site] = int(num)
+
+    jobs = batch_dl.read_jobs(args.watchlist)
+    unknown = {job.site for job in jobs} - set(batch_dl.ADAPTERS)
+    if unknown:
+        parser.error(f"unknown site(s): {', '.join(sorted(unknown))}; known: {', '.join(batch_dl.ADAPTERS)}")
+
+    state = WatchState(args.state or args.watchlist + STATE_SUFFIX)
+    try:
+        watch(jobs, state, budgets, args.titles, args.once, args.min_interval, args.max_interval)
+    except KeyboardInterrupt:
+        print("Stopped")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,40 @@
 #!/usr/bin/env python
 
-import requests
-import bs4
 import argparse
 import sys
 from dataclasses import dataclass
-import pdfkit
-import os
-import time
-import subprocess
 import datetime
+import scrapeutil
+import httpcache
+import httpsession
+import htmlparse
+import novelstore
+import novelrender
+import epubwriter
+import metrics
+import profiling
 #--------   constants   --------
 URL_BASE = "https://www.webnovelpub.com{rest}"
 URL_MAIN = "https://www.webnovelpub.com/novel/{slug}/chapters/page-{page_num}"
-POLITENESS_FACTOR = 0.2                         # delay between downloads, in seconds
+START_RATE = 5                                  # requests per second to a host without a rate saved by an earlier run
+MAX_RATE = 10                                   # the adaptive rate never goes above this
+WORKERS = 1                                     # concurrent chapter downloads
+METADATA_HTML = """
+                <p style="page-break-before: always;">
+                    <b>Extra metadata</b>
+                    <p>Downloaded from: webnovelpub</p>
+                    <p >Created on: {date} </p>
+                    <p>Created using: <a href="https://github.com/sanskarchand/useful_scripts">webnovel</a></p>
+                </p>"""
 #--------   /constants  --------
 headers = {
             "User-Agent": "Mozilla/5.0 (X11; Linux i686; rv:109.0) Gecko/20100101 Firefox/109.0."
 }
+
+# per-host rate, adapted to the responses and remembered across runs;
+# shared by all the workers
+rate_limiter = scrapeutil.AdaptiveRateLimiter(START_RATE, MAX_RATE, scrapeutil.RATE_STATE_PATH)
+session = httpsession.make_session(headers=headers)
     
 
 
@@ -36,121 +53,171 @@ def clean_chapter_anme(chapName):
     return chapName.replace(':', '_')
 
 def get_chapter_content(chapter_html):
-    soup = bs4.BeautifulSoup(chapter_html, 'html.parser')
+    soup = htmlparse.parse(chapter_html, "div", {"id": "chapter-container"})
     div = soup.find("div", {"id": "chapter-container"})
     content = div.find_all("p")
 
     return content
 
-def make_pdf(chapter_list, slug):
-
-    #generate default toc
-    if not os.path.exists("default_toc.xsl"):
-        with open('default_toc.xsl', 'w') as outfile:
-            subprocess.call(['wkhtmltopdf', '--dump-default-toc-xsl'], stdout=outfile)
-
-    toc = {
-        'xsl-style-sheet': 'default_toc.xsl'
-    }
-
-    body = ''
-    for index in range(len(chapter_list)):
+def fetch_chapter(chapter):
+    url = URL_BASE.format(rest=chapter.url)
+    with profiling.stage("network", chapter.name):
+        resp = httpcache.http_cache.get(url, httpcache.TTL_CHAPTER,
+                                        rate_limiter.limit(metrics.instrument(session.get, "page_fetch")))
+    with profiling.stage("parse", chapter.name):
+        content = get_chapter_content(resp.text)
+    with profiling.stage("assemble", chapter.name):
+        return "".join(str(c) for c in content)
+
+def download_chapters(chapter_list, slug, workers=WORKERS):
+    """
+    Fetch the chapters that are missing from the novel's store and return the store.
+    chapter_list must be sorted by Chapter.index.
+    """
+    # only chapters missing from the store are downloaded
+    store = novelstore.NovelStore(slug)
+    missing = store.missing(chapter_list)
+    print(f"Downloading {len(missing)} new chapters of {len(chapter_list)}")
+    for index, (chapter, content) in enumerate(scrapeutil.fetch_in_order(missing, fetch_chapter, workers)):
         print(f"Processing chapter {index+1}...")
-        chapter = chapter_list[index]
-        resp = requests.get(URL_BASE.format(rest=chapter.url), headers=headers)
-        content = [str(c)  for c in get_chapter_content(resp.text)]
+        with profiling.stage("store", chapter.name):
+            store.add(chapter, content)
+    store.save()
+
+    return store
 
-        # add this chapter to the body
+def sections(chapter_list, store):
+    """
+    Chapter HTML for the PDF, read back from the store one chapter at a time
+    """
+    for index, chapter in enumerate(chapter_list):
+        content = store.load(chapter)
         if index == 0:
-            body += f'<h2>{chapter.name}</h2>'+ "".join(content)
+            yield f'<h2>{chapter.name}</h2>' + content
         else:
-            body += f'<h2 style="page-break-before: always;">{chapter.name}</h2>'+ "".join(content)
+            yield f'<h2 {novelrender.PAGE_BREAK}>{chapter.name}</h2>' + content
 
-        time.sleep(POLITENESS_FACTOR)
+def make_pdf(chapter_list, store, slug, volume_size=0, split=False, render_jobs=novelrender.RENDER_JOBS):
 
-    options = {
-            'margin-bottom': '20mm',
-            'footer-center': '[page]'
-    }
-        
-    output = """
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <meta charset="utf-8">
-            </head>
-            <body>
-            {body}
-                <p style="page-break-before: always;">
-                    <b>Extra metadata</b>
-                    <p>Downloaded from: webnovelpub</p>
-                    <p >Created on: {date} </p>
-                    <p>Created using: <a href="https://github.com/sanskarchand/useful_scripts">webnovel</a></p>
-                </p>
-            </body>
-            </html>""".format(body=body, 
-                            date=str(datetime.datetime.now()),
-                    )      # handle unicode
+    metadata = METADATA_HTML.format(date=str(datetime.datetime.now()))      # handle unicode
 
-    #pdfkit.from_string(output, "{name}.pdf", options=options)
-    
-    pdfkit.from_string(output, f"{slug}.pdf", toc=toc, options=options)
+    if volume_size:
+        volumes = [sections(chapter_list[start:start+volume_size], store)
+                   for start in range(0, len(chapter_list), volume_size)]
+        novelrender.render_volumes(volumes, metadata, f"{slug}.pdf", render_jobs, merge=not split)
+    else:
+        novelrender.render_pdf(sections(chapter_list, store), metadata, f"{slug}.pdf")
 
-def extract_chapters(html_page, slug=None):
-    chapter_list = []
+def make_epub(chapter_list, store, slug):
+    with epubwriter.EpubWriter(f"{slug}.epub", slug, source=URL_MAIN.format(slug=slug, page_num=1)) as book:
+        for chapter in chapter_list:
+            with profiling.stage("epub", chapter.name):
+                book.add_chapter(chapter.name, f'<h2>{chapter.name}</h2>' + store.load(chapter))
+
+def has_chapter_items(soup):
+    return soup.find("li", attrs={"data-chapterno": True}) is not None
 
-    soup = bs4.BeautifulSoup(html_page, 'html.parser')
+def page_chapter_links(soup):
+    chapterListCurrent = soup.find_all("li", attrs={"data-chapterno": True})
+    chapterAnchors = [chap.find('a') for chap in chapterListCurrent]
+    return [(chap["title"], chap['href']) for chap in chapterAnchors]
+
+def count_pages(soup):
+    """
+    Number of chapter list pages, from the pagination of any of them
+    """
     numPagesCont = soup.find("li", {"class": "PagedList-skipToLast"})
     lastPageURL =  numPagesCont.find("a")["href"] 
 
     ind = lastPageURL.rfind("-")
-    totalNumPages = int(lastPageURL[ind+1:])
-    headers = {
-            "User-Agent": "Mozilla/5.0 (X11; Linux i686; rv:109.0) Gecko/20100101 Firefox/109.0."
-    }
-    
+    return int(lastPageURL[ind+1:])
 
-        
-    for page_num in  range(1, totalNumPages):
-        
-        if page_num != 1: 
-            r = requests.get(URL_MAIN.format(slug=slug, page_num=page_num), headers=headers)
-            if r.status_code != 200:
-                print(f"Error: Could not get main page (Status {r.status_code}). Aborting...")
-                sys.exit(1)
+def extract_chapters(html_page, slug=None, workers=WORKERS):
+    chapter_list = []
+
+    soup = htmlparse.parse(html_page, "li", check=has_chapter_items)
+    totalNumPages = count_pages(soup)
 
-            soup = bs4.BeautifulSoup(r.text, 'html.parser')
+    def fetch_page(page_num):
+        url = URL_MAIN.format(slug=slug, page_num=page_num)
+        r = httpcache.http_cache.get(url, httpcache.TTL_LIST,
+                                     rate_limiter.limit(metrics.instrument(session.get, "list_fetch")))
+        if r.status_code != 200:
+            print(f"Error: Could not get main page (Status {r.status_code}). Aborting...")
+            sys.exit(1)
+        return page_chapter_links(htmlparse.parse(r.text, "li", check=has_chapter_items))
 
-        chapterListCurrent = soup.find_all("li", attrs={"data-chapterno": True})
-        chapterAnchors = [chap.find('a') for chap in chapterListCurrent]
-        for idx, chap in enumerate(chapterAnchors):
-            chapterName = chap["title"]
-            chapterURL = chap['href']
-            chapter_list.append( Chapter(idx, chapterName, chapterURL) )
+    # page 1 is already here; the rest are fetched concurrently, but merged in page order
+    pages = [page_chapter_links(soup)]
+    for page_num, links in scrapeutil.fetch_in_order(range(2, totalNumPages + 1), fetch_page, workers):
+        pages.append(links)
 
-        time.sleep(POLITENESS_FACTOR)
+    for links in pages:
+        for chapterName, chapterURL in links:
+            # index across all list pages, so that chapters can be ordered by it
+            chapter_list.append( Chapter(len(chapter_list), chapterName, chapterURL) )
 
     return chapter_list
 
+def get_chapter_list(slug, workers=WORKERS):
+    """
+    The novel's chapters, sorted by index
+    """
+    print("Getting chapter list...")
+    url = URL_MAIN.format(slug=slug, page_num=1)
+    r = httpcache.http_cache.get(url, httpcache.TTL_LIST, rate_limiter.limit(metrics.instrument(session.get, "list_fetch")))
+    if r.status_code != 200:
+        print(f"Error: Could not get main page (Status {r.status_code})")
+
+    chapter_list = extract_chapters(r.text, slug, workers)
+    print(f"There are {len(chapter_list)} chapters")
+    chapter_list.sort(key=lambda chap: chap.index)
+    return chapter_list
+
 def main():
-    if len(sys.argv) == 1:
-        slug = "the-regressed-demon-lord-is-kind-04022146"
-    else:
-        slug = sys.argv[1]
+    parser = argparse.ArgumentParser()
+    parser.add_argument("slug", nargs="?", default="the-regressed-demon-lord-is-kind-04022146",
+                        help="Novel slug, as it appears in the URL")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="Number of chapters to download concurrently")
+    parser.add_argument("--rate", type=float, default=MAX_RATE,
+                        help="Max requests per second to the host; the rate adapts below it")
+    parser.add_argument("--fixed-rate", action="store_true",
+                        help="Send exactly --rate requests per second to the host, without adapting")
+    parser.add_argument("--no-cache", action="store_true", help="Bypass the shared HTTP cache")
+    parser.add_argument("--volume-size", type=int, default=0,
+                        help="Render volumes of this many chapters in parallel (0 = one document)")
+    parser.add_argument("--split", action="store_true", help="Keep the volumes as separate PDFs instead of merging them")
+    parser.add_argument("--render-jobs", type=int, default=novelrender.RENDER_JOBS,
+                        help="Number of volumes rendered at once")
+    parser.add_argument("--format", choices=["pdf", "epub"], default="pdf", help="Output format")
+    parser.add_argument("--metrics", help="Export Prometheus metrics to this file (and a JSON run summary next to it)")
+    parser.add_argument("--profile", metavar="PREFIX",
+                        help="Time every stage per chapter; write PREFIX.txt and a PREFIX.trace.json timeline")
+    parser.add_argument("--cprofile", action="store_true", help="With --profile, also run cProfile on all threads")
+    parser.add_argument("--tracemalloc", action="store_true", help="With --profile, also trace memory allocations")
+    args = parser.parse_args()
+    if (args.cprofile or args.tracemalloc) and not args.profile:
+        parser.error("--cprofile and --tracemalloc need --profile")
+
+    slug = args.slug
+    rate_limiter.set_rate(args.rate, adaptive=not args.fixed_rate)
+    httpcache.http_cache.enabled = not args.no_cache
+    metrics.configure(args.metrics)
+    if args.profile:
+        profiling.enable(args.profile, args.cprofile, args.tracemalloc)
     
     headers = {
             "User-Agent": "Mozilla/5.0 (X11; Linux i686; rv:109.0) Gecko/20100101 Firefox/109.0."
     }
     
     
-    print("Getting chapter list...")
-    r = requests.get(URL_MAIN.format(slug=slug, page_num=1), headers=headers)
-    if r.status_code != 200:
-        print(f"Error: Could not get main page (Status {r.status_code})")
-    
-    chapter_list = extract_chapters(r.text, slug)
-    print(f"There are {len(chapter_list)} chapters")
-    make_pdf(chapter_list, slug)
+    chapter_list = get_chapter_list(slug, args.workers)
+    store = download_chapters(chapter_list, slug, args.workers)
+    if args.format == "epub":
+        make_epub(chapter_list, store, slug)
+    else:
+        make_pdf(chapter_list, store, slug, args.volume_size, args.split, args.render_jobs)
+    httpsession.print_stats(session)
 
 if __name__ == '__main__':
     main()
@@ -1,22 +1,36 @@
 #!/usr/bin/env python
 
-import requests
-import bs4
 import argparse
-import sys
 from dataclasses import dataclass
 import cloudscraper
-import pdfkit
-import os
-import time
-import subprocess
 import datetime
+import scrapeutil
+import httpcache
+import httpsession
+import htmlparse
+import novelstore
+import novelrender
+import epubwriter
+import metrics
 #--------   constants   --------
 URL_CHAPTER = "https://www.wuxiaworld.com{chapPath}"
 URL = "https://www.wuxiaworld.com/novel/{novelName}"
-POLITENESS_FACTOR = 0.2                         # delay between downloads, in seconds
+START_RATE = 5                                  # requests per second to a host without a rate saved by an earlier run
+MAX_RATE = 10                                   # the adaptive rate never goes above this
+WORKERS = 1                                     # concurrent chapter downloads
+METADATA_HTML = """
+                <p style="page-break-before: always;">
+                    <b>Extra metadata</b>
+                    <p>Downloaded from: <a href="{url}">{name}</a></p>
+                    <p >Created on: {date} </p>
+                    <p>Created using: <a href="https://github.com/sanskarchand/useful_scripts">wuxial-dl</a></p>
+                </p>"""
 #--------   /constants  --------
 
+# per-host rate, adapted to the responses and remembered across runs;
+# shared by all the workers
+rate_limiter = scrapeutil.AdaptiveRateLimiter(START_RATE, MAX_RATE, scrapeutil.RATE_STATE_PATH)
+
 
 @dataclass
 class Chapter:
@@ -33,7 +47,7 @@ def clean_chapter_anme(chapName):
     return chapName.replace(':', '_')
 
 def get_chapter_content(chapter_html):
-    soup = bs4.BeautifulSoup(chapter_html, 'html.parser')
+    soup = htmlparse.parse(chapter_html, "div", {"id": "chapter-content"})
     div = soup.find("div", {"id": "chapter-content"})
     node = div.find("script")
     content = []
@@ -45,66 +59,64 @@ def get_chapter_content(chapter_html):
 
     return content
 
-def make_pdf(chapter_list, name, scraper):
-
-    #generate default toc
-    if not os.path.exists("default_toc.xsl"):
-        with open('default_toc.xsl', 'w') as outfile:
-            subprocess.call(['wkhtmltopdf', '--dump-default-toc-xsl'], stdout=outfile)
+def fetch_chapter(chapter, scraper):
+    url = URL_CHAPTER.format(chapPath=chapter.url)
+    resp = httpcache.http_cache.get(url, httpcache.TTL_CHAPTER,
+                                    rate_limiter.limit(metrics.instrument(scraper.get, "page_fetch")))
+    return "".join(str(c) for c in get_chapter_content(resp.text))
 
-    toc = {
-        'xsl-style-sheet': 'default_toc.xsl'
-    }
+def download_chapters(chapter_list, name, scraper, workers=WORKERS):
+    """
+    Fetch the chapters that are missing from the novel's store and return the store.
+    chapter_list must be sorted by Chapter.index.
+    """
+    fetch = lambda chapter: fetch_chapter(chapter, scraper)
 
-    body = ''
-    for index in range(len(chapter_list)):
+    # only chapters missing from the store are downloaded
+    store = novelstore.NovelStore(name)
+    missing = store.missing(chapter_list)
+    print(f"Downloading {len(missing)} new chapters of {len(chapter_list)}")
+    for index, (chapter, content) in enumerate(scrapeutil.fetch_in_order(missing, fetch, workers)):
         print(f"Processing chapter {index+1}...")
-        chapter = chapter_list[index]
-        resp = scraper.get(URL_CHAPTER.format(chapPath=chapter.url))
-        content = [str(c) for c in get_chapter_content(resp.text)]
+        store.add(chapter, content)
+    store.save()
 
-        # add this chapter to the body
+    return store
+
+def sections(chapter_list, store):
+    """
+    Chapter HTML for the PDF, read back from the store one chapter at a time
+    """
+    for index, chapter in enumerate(chapter_list):
+        content = store.load(chapter)
         if index == 0:
-            body += f'<h2>{chapter.name}</h2>'+ "".join(content)
+            yield f'<h2>{chapter.name}</h2>' + content
         else:
-            body += f'<h2 style="page-break-before: always;">{chapter.name}</h2>'+ "".join(content)
+            yield f'<h2 {novelrender.PAGE_BREAK}>{chapter.name}</h2>' + content
 
-        time.sleep(POLITENESS_FACTOR)
+def make_pdf(chapter_list, store, name, volume_size=0, split=False, render_jobs=novelrender.RENDER_JOBS):
 
-    options = {
-            'margin-bottom': '20mm',
-            'footer-center': '[page]'
-    }
-        
-    output = """
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <meta charset="utf-8">
-            </head>
-            <body>
-            {body}
-                <p style="page-break-before: always;">
-                    <b>Extra metadata</b>
-                    <p>Downloaded from: <a href="{url}">{name}</a></p>
-                    <p >Created on: {date} </p>
-                    <p>Created using: <a href="https://github.com/sanskarchand/useful_scripts">wuxial-dl</a></p>
-                </p>
-            </body>
-            </html>""".format(body=body, 
-                            date=str(datetime.datetime.now()),
-                            name=name,
-                            url=URL.format(novelName=name)
+    metadata = METADATA_HTML.format(date=str(datetime.datetime.now()),
+                                    name=name,
+                                    url=URL.format(novelName=name)
                     )      # handle unicode
 
-    #pdfkit.from_string(output, "{name}.pdf", options=options)
-    
-    pdfkit.from_string(output, f"{name}.pdf", toc=toc, options=options)
+    if volume_size:
+        volumes = [sections(chapter_list[start:start+volume_size], store)
+                   for start in range(0, len(chapter_list), volume_size)]
+        novelrender.render_volumes(volumes, metadata, f"{name}.pdf", render_jobs, merge=not split)
+    else:
+        novelrender.render_pdf(sections(chapter_list, store), metadata, f"{name}.pdf")
+
+def make_epub(chapter_list, store, name):
+    with epubwriter.EpubWriter(f"{name}.epub", name, source=URL.format(novelName=name)) as book:
+        for chapter in chapter_list:
+            book.add_chapter(chapter.name, f'<h2>{chapter.name}</h2>' + store.load(chapter))
 
 def extract_chapters(html_page):
     chapter_list = []
 
-    soup = bs4.BeautifulSoup(html_page, 'html.parser')
+    soup = htmlparse.parse(html_page, "li", {"class": "chapter-item"})
     chapterLists = soup.find_all("li", attrs={"class": "chapter-item"})
     chapterAnchors = [chap.find('a') for chap in chapterLists]
     for idx, chap in enumerate(chapterAnchors):
@@ -115,21 +127,53 @@ def extract_chapters(html_page):
 
     return chapter_list
 
+def get_chapter_list(novelName, scraper):
+    """
+    The novel's chapters, sorted by index
+    """
+    r = httpcache.http_cache.get(URL.format(novelName=novelName), httpcache.TTL_LIST,
+                                 rate_limiter.limit(metrics.instrument(scraper.get, "list_fetch")))
+    if r.status_code != 200:
+        print(f"Error: Could not get main page (Status {r.status_code})")
+
+    chapter_list = extract_chapters(r.text)
+    chapter_list.sort(key=lambda chap: chap.index)
+    return chapter_list
+
 def main():
-    if len(sys.argv) == 1:
-        novelName = 'the-second-coming-of-gluttony'
-    else:
-        novelName = sys.argv[1]
+    parser = argparse.ArgumentParser()
+    parser.add_argument("novelName", nargs="?", default='the-second-coming-of-gluttony',
+                        help="Name of the novel, as it appears in the URL")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="Number of chapters to download concurrently")
+    parser.add_argument("--rate", type=float, default=MAX_RATE,
+                        help="Max requests per second to the host; the rate adapts below it")
+    parser.add_argument("--fixed-rate", action="store_true",
+                        help="Send exactly --rate requests per second to the host, without adapting")
+    parser.add_argument("--no-cache", action="store_true", help="Bypass the shared HTTP cache")
+    parser.add_argument("--volume-size", type=int, default=0,
+                        help="Render volumes of this many chapters in parallel (0 = one document)")
+    parser.add_argument("--split", action="store_true", help="Keep the volumes as separate PDFs instead of merging them")
+    parser.add_argument("--render-jobs", type=int, default=novelrender.RENDER_JOBS,
+                        help="Number of volumes rendered at once")
+    parser.add_argument("--format", choices=["pdf", "epub"], default="pdf", help="Output format")
+    parser.add_argument("--metrics", help="Export Prometheus metrics to this file (and a JSON run summary next to it)")
+    args = parser.parse_args()
+
+    novelName = args.novelName
+    rate_limiter.set_rate(args.rate, adaptive=not args.fixed_rate)
+    httpcache.http_cache.enabled = not args.no_cache
+    metrics.configure(args.metrics)
 
     
-    scraper = cloudscraper.create_scraper()
+    scraper = httpsession.configure(cloudscraper.create_scraper())
 
-    r = scraper.get(URL.format(novelName=novelName))
-    if r.status_code != 200:
-        print(f"Error: Could not get main page (Status {r.status_code})")
-    
-    chapter_list = extract_chapters(r.text)
-    make_pdf(chapter_list, novelName, scraper)
+    chapter_list = get_chapter_list(novelName, scraper)
+    store = download_chapters(chapter_list, novelName, scraper, args.workers)
+    if args.format == "epub":
+        make_epub(chapter_list, store, novelName)
+    else:
+        make_pdf(chapter_list, store, novelName, args.volume_size, args.split, args.render_jobs)
+    httpsession.print_stats(scraper)
 
 if __name__ == '__main__':
     main()